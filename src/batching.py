@@ -0,0 +1,72 @@
+import asyncio
+import contextvars
+
+from retry import shared
+
+
+class MicroBatcher:
+    """Merges single lookups made within a short window into one bulk request.
+
+    Parameters
+    ----------
+    fetch_many : async callable
+        Takes a list of keys and returns a dictionary with a result for each of them.
+    delay : float
+        Seconds to wait for more keys after the first one of a batch arrived.
+    max_batch : int
+        A batch is sent right away once it holds this many keys.
+    """
+
+    def __init__(self, fetch_many, delay=0.05, max_batch=100):
+        self.fetch_many = fetch_many
+        self.delay = delay
+        self.max_batch = max_batch
+        self.pending = {}
+        self.running = set()
+        self.timer = None
+        self.batches = 0
+        self.keys = 0
+
+    async def get(self, key):
+        if (future := self.pending.get(key)) is None:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[key] = future
+
+            if len(self.pending) >= self.max_batch:
+                self._flush()
+            elif self.timer is None:
+                self.timer = asyncio.get_running_loop().call_later(self.delay, self._flush)
+
+        return await shared(future)
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        batch, self.pending = self.pending, {}
+        if batch:
+            # Run outside the context of the caller, so its deadline does not fail the batch for everybody else
+            task = asyncio.get_running_loop().create_task(self._run(batch), context=contextvars.Context())
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def _run(self, batch):
+        self.batches += 1
+        self.keys += len(batch)
+
+        try:
+            results = await self.fetch_many(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for key, future in batch.items():
+            if future.done():
+                continue
+            if key in results:
+                future.set_result(results[key])
+            else:
+                future.set_exception(ValueError(f"No result for {key} in batch!"))
@@ -0,0 +1,200 @@
+import asyncio
+import contextvars
+import copy
+import functools
+import logging
+import time
+from collections import OrderedDict
+
+from metrics import metrics
+from retry import shared
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Dictionary holding at most `maxsize` entries, evicting the least recently used one first.
+
+    Entries can expire after `ttl` seconds, either set for the whole cache or per entry.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.expires = {}
+
+    def _expired(self, key):
+        if (expires := self.expires.get(key)) is not None and expires <= time.monotonic():
+            self.pop(key)
+            return True
+        return False
+
+    def get(self, key, default=None):
+        if self._expired(key):
+            return default
+        try:
+            self.data.move_to_end(key)
+        except KeyError:
+            return default
+        return self.data[key]
+
+    def set(self, key, value, ttl=None):
+        self.data[key] = value
+        self.data.move_to_end(key)
+
+        if (ttl := ttl if ttl is not None else self.ttl) is not None:
+            self.expires[key] = time.monotonic() + ttl
+        else:
+            self.expires.pop(key, None)
+
+        while len(self.data) > self.maxsize:
+            oldest, _ = self.data.popitem(last=False)
+            self.expires.pop(oldest, None)
+
+    def pop(self, key, default=None):
+        self.expires.pop(key, None)
+        return self.data.pop(key, default)
+
+    def clear(self):
+        self.data.clear()
+        self.expires.clear()
+
+    def items(self):
+        """Returns all entries that have not expired, from least to most recently used."""
+        return [(key, value) for key, value in list(self.data.items()) if not self._expired(key)]
+
+    def __contains__(self, key):
+        return not self._expired(key) and key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+
+class _Failure:
+    """Cached exception of a call that would fail the same way if repeated."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+class _Stale:
+    """Cached result that is still served after `fresh_until`, while a refresh runs in the background."""
+
+    def __init__(self, value, fresh_until):
+        self.value = value
+        self.fresh_until = fresh_until
+
+
+def cached(maxsize=1024, ttl=None, negative=(), negative_ttl=60, stale_ttl=None, name=None):
+    """Caches the results of an async function by its arguments.
+
+    Concurrent calls with the same arguments share one call. Hit and miss counts are reported to metrics.
+    With `stale_ttl`, expired results keep being served while a single background call refreshes them,
+    and a failing refresh keeps the old result.
+
+    Parameters
+    ----------
+    maxsize : int
+        Number of results to keep before evicting the least recently used one.
+    ttl : float
+        Seconds a result is kept, None to keep it until evicted.
+    negative : tuple
+        Exceptions that are cached as well, e.g. for 4xx responses that would fail again.
+    negative_ttl : float
+        Seconds a cached exception is kept.
+    stale_ttl : float
+        Seconds a result is served after `ttl` passed, None to not serve stale results at all.
+    name : str
+        Name of the cache in the metrics, defaults to the module and name of the function.
+    """
+
+    def decorator(func):
+        cache = LRUCache(maxsize, ttl)
+        inflight = {}
+        stats = {"hits": 0, "misses": 0}
+
+        def store(key, result):
+            if stale_ttl is None:
+                cache.set(key, result)
+            else:
+                cache.set(key, _Stale(result, time.monotonic() + ttl), ttl=ttl + stale_ttl)
+
+        async def fill(key, args, kwargs):
+            try:
+                result = await func(*args, **kwargs)
+            except negative as e:
+                cache.set(key, _Failure(e), ttl=negative_ttl)
+                raise
+            store(key, result)
+            return result
+
+        async def refresh(key, args, kwargs):
+            entry = cache.get(key)
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                if not isinstance(entry, _Stale):
+                    raise
+                # Keep serving what we have, it is better than nothing while upstream is failing
+                logger.warning(f"Could not refresh {func.__qualname__}{args}: {e}")
+                entry.fresh_until = time.monotonic() + min(ttl, 60)
+                cache.set(key, entry, ttl=stale_ttl)
+                return entry.value
+
+            store(key, result)
+            return result
+
+        def start(key, coroutine):
+            # Run outside the context of the caller, so its deadline does not cut the call short for everybody else
+            task = asyncio.get_running_loop().create_task(coroutine, context=contextvars.Context())
+            inflight[key] = task
+            task.add_done_callback(functools.partial(forget, key))
+            return task
+
+        def forget(key, task):
+            if inflight.get(key) is task:
+                del inflight[key]
+            # Mark the exception as retrieved in case every waiter was cancelled
+            if not task.cancelled():
+                task.exception()
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items()))) if kwargs else args
+
+            if (entry := cache.get(key, _MISSING)) is not _MISSING:
+                stats["hits"] += 1
+                if isinstance(entry, _Failure):
+                    raise copy.copy(entry.error)
+                if not isinstance(entry, _Stale):
+                    return entry
+
+                if entry.fresh_until <= time.monotonic() and key not in inflight:
+                    start(key, refresh(key, args, kwargs))
+                return entry.value
+            stats["misses"] += 1
+
+            if (task := inflight.get(key)) is None:
+                task = start(key, fill(key, args, kwargs))
+
+            return await shared(task)
+
+        async def refresh_now(*args, **kwargs):
+            """Calls the function right away and caches the result, keeping a stale result if that fails."""
+            key = (args, tuple(sorted(kwargs.items()))) if kwargs else args
+            if (task := inflight.get(key)) is None:
+                task = start(key, refresh(key, args, kwargs))
+            return await shared(task)
+
+        wrapper.cache = cache
+        wrapper.refresh = refresh_now
+        wrapper.cache_info = lambda: {**stats, "size": len(cache), "maxsize": maxsize}
+        wrapper.cache_clear = cache.clear
+
+        metrics.cache(name or f"{func.__module__}.{func.__qualname__}", lambda: (stats["hits"], stats["misses"]))
+        return wrapper
+
+    return decorator
@@ -6,7 +6,10 @@ from collections import defaultdict
 
 from discord.ext import commands
 
-from network import get, get_dogma_attributes, get_item_name
+import prewarm
+from cache import cached
+from contracts import ContractSync
+from network import get, get_dogma_attributes, get_item_name, get_items_data
 from utils import convert, command_error_handler, unix_style_arg_parser
 
 # Configure the logger
@@ -188,7 +191,8 @@ class Module:
             self.mutated_attributes[0] = float("inf")
 
     def calculate_attributes(self, skill=5):
-        attrs = self.basic_attributes
+        # Work on a copy, the skill bonuses below must not pile up on the cached module
+        attrs = dict(self.basic_attributes)
         attrs.update(self.mutated_attributes)
 
         # Calculate skill bonuses (assume all V)
@@ -237,17 +241,21 @@ class Module:
         return ret
 
 
-async def get_abyssals(type_id: int):
+async def fetch_contracts(type_id: int):
     url = f"https://mutamarket.com/api/modules/type/{type_id}/item-exchange/contracts-only/"
-    item_data = await get(url)
+    return await get(url)
+
 
+async def build_modules(type_id: int, item_data):
+    """Builds modules for new or changed contracts, unchanged ones are kept by the contract sync"""
     modules = [Module(json=j) for j in item_data]
 
     # Collect unique type_ids
     attribute_type_ids = {m.source_type_id for m in modules}
     name_type_ids = {m.type_id for m in modules}
 
-    # Fetch all attributes and names in parallel
+    # Fill the static data cache for all types in one go, then fetch attributes and names in parallel
+    await get_items_data(attribute_type_ids)
     attribute_data = await asyncio.gather(*(get_dogma_attributes(tid) for tid in attribute_type_ids))
     name_data = await asyncio.gather(*(get_item_name(tid) for tid in name_type_ids))
 
@@ -257,7 +265,7 @@ async def get_abyssals(type_id: int):
 
     # Distribute fetched data to modules
     for module in modules:
-        attributes = attribute_map.get(module.source_type_id, [])
+        attributes = attribute_map.get(module.source_type_id, {})
         for attribute_id, value in attributes.items():
             module.basic_attributes[attribute_id] = value
 
@@ -266,6 +274,14 @@ async def get_abyssals(type_id: int):
     return modules
 
 
+module_contracts = ContractSync("abyssal_modules", fetch_contracts, build_modules)
+
+
+@cached(maxsize=256, ttl=60, stale_ttl=900)
+async def get_abyssals(type_id: int):
+    return await module_contracts.sync(type_id)
+
+
 def combine_stats(combination):
     # Calculate combination stats
     stats = {}
@@ -494,4 +510,5 @@ async def multi(ctx, *args):
 
 
 async def setup(bot):
+    prewarm.register("abyssal_modules", 600, module_registry.id_to_entity, get_abyssals.refresh)
     bot.add_command(multi)
@@ -1,14 +1,21 @@
 import asyncio
-import functools
+import bisect
 import heapq
+import itertools
 import math
+import time
 from typing import Any, Generator, Optional
 
-from async_lru import alru_cache
+import numpy as np
 from discord import Interaction, app_commands
 from discord.ext import commands
 
-from network import get_item_price, get
+import parallel
+import prewarm
+from cache import cached
+from contracts import ContractSync
+from network import get_item_price, get, refresh_item_prices
+from retry import DeadlineExceeded
 from utils import RelationalSorter, isk, slash_command_error_handler
 from utils import convert
 
@@ -72,6 +79,9 @@ class DamageModSet:
     def stacking(u):
         return math.exp(-(u / 2.67) ** 2)
 
+    # Stacking penalty of the n-th strongest module, far more than ever fit on a ship
+    penalties = list(map(stacking, range(32)))
+
     def __init__(self, damage_mods: list):
         self.damage_mods = damage_mods
 
@@ -79,36 +89,38 @@ class DamageModSet:
     def damage_multiplier(self):
         return self.get_damage_multiplier()
 
-    def get_damage_multiplier(self, uptime=1, rof_rig="", damage_rig=""):
+    @staticmethod
+    def rig_bonuses(rof_rig="", damage_rig=""):
+        """Damage and rate of fire multipliers of the fitted rigs"""
+        damage_multipliers = {"t1": [1.1], "t2": [1.15], "t1x2": [1.1, 1.1]}.get(damage_rig.lower(), [])
+        rof_multipliers = {"t1": [1 / 1.1], "t2": [1 / 1.15], "t1x2": [1 / 1.1, 1 / 1.1]}.get(rof_rig.lower(), [])
+        return damage_multipliers, rof_multipliers
 
-        damage_multipliers = [x.damage for x in self.damage_mods]
-        if damage_rig.lower() == "t1":
-            damage_multipliers.append(1.1)
-        if damage_rig.lower() == "t2":
-            damage_multipliers.append(1.15)
-        if damage_rig.lower() == "t1x2":
-            damage_multipliers.extend([1.1, 1.1])
+    @staticmethod
+    def combined_multiplier(damage_multipliers, rof_multipliers, uptime=1):
+        """Damage multiplier of stacking all damage and rate of fire multipliers, including rigs"""
+        penalties = DamageModSet.penalties
 
         damage_increase = 1
         for x, value in enumerate(sorted(damage_multipliers, reverse=True)):
-            damage_increase *= (1 + ((value - 1) * self.stacking(x)))
-
-        rof_multipliers = [x.rof for x in self.damage_mods]
-        if rof_rig.lower() == "t1":
-            rof_multipliers.append(1 / 1.1)
-        if rof_rig.lower() == "t2":
-            rof_multipliers.append(1 / 1.15)
-        if rof_rig.lower() == "t1x2":
-            rof_multipliers.extend([1 / 1.1, 1 / 1.1])
+            damage_increase *= (1 + ((value - 1) * penalties[x]))
 
         rof_time_decrease = 1
         for x, value in enumerate(sorted(rof_multipliers)):
-            rof_time_decrease *= 1 + ((value - 1) * self.stacking(x))
+            rof_time_decrease *= 1 + ((value - 1) * penalties[x])
 
         rof_time_decrease = (uptime * rof_time_decrease + (1 - uptime))
 
         return damage_increase / rof_time_decrease
 
+    def get_damage_multiplier(self, uptime=1, rof_rig="", damage_rig=""):
+        damage_rigs, rof_rigs = self.rig_bonuses(rof_rig, damage_rig)
+        return self.combined_multiplier(
+            [x.damage for x in self.damage_mods] + damage_rigs,
+            [x.rof for x in self.damage_mods] + rof_rigs,
+            uptime
+        )
+
     @property
     def cpu(self):
         return sum([x.cpu for x in self.damage_mods])
@@ -123,47 +135,57 @@ class DamageModSet:
         return out
 
 
-@alru_cache(ttl=60)
-async def get_abyssals_mutamarket(type_id: int, type_name: str):
-    """Fetch all abyssals from a certain type from the mutamarket API"""
+async def fetch_contracts(type_id: int):
     url = f"https://mutamarket.com/api/modules/type/{type_id}/item-exchange/contracts-only/?region_id=10000002"
-    item_data = await get(url)
+    return await get(url)
 
-    modules = []
-    for item in item_data:
-        if not (contract := item.get("contract")):
-            continue
 
-        if not contract.get("type") == "item_exchange":
-            continue
+def damage_mod_from_contract(item, type_name):
+    """Returns the DamageMod offered by a mutamarket contract, or None if it can not simply be bought"""
+    if not (contract := item.get("contract")):
+        return None
 
-        # Region now in querry parameter
-        # if not contract.get("region_id", 10000002) == 10000002:
-        #     continue
+    if not contract.get("type") == "item_exchange":
+        return None
 
-        if not contract.get("plex_count", 0) == 0:
-            continue
+    # Region now in querry parameter
+    # if not contract.get("region_id", 10000002) == 10000002:
+    #     return None
 
-        if contract.get("asking_for_items", True):
-            continue
+    if not contract.get("plex_count", 0) == 0:
+        return None
 
-        attributes = {a.get("id"): a.get("value") for a in item.get("mutated_attributes", [])}
+    if contract.get("asking_for_items", True):
+        return None
 
-        module = DamageMod(
-            type_id=item.get("mutator_type_id"),
-            type_name=type_name
-        )
+    attributes = {a.get("id"): a.get("value") for a in item.get("mutated_attributes", [])}
 
-        module.add_stats_from_attributes(attributes)
-        module.price = contract.get("price")
+    module = DamageMod(
+        type_id=item.get("mutator_type_id"),
+        type_name=type_name
+    )
+
+    module.add_stats_from_attributes(attributes)
+    module.price = contract.get("price")
+
+    module.add_unique_instance(
+        module_id=item.get("id"),
+        contract_id=contract.get("id")
+    )
+    return module
 
-        module.add_unique_instance(
-            module_id=item.get("id"),
-            contract_id=contract.get("id")
-        )
 
-        modules.append(module)
-    return modules
+async def build_damage_mods(type_id: int, item_data, type_name: str):
+    return [damage_mod_from_contract(item, type_name) for item in item_data]
+
+
+damage_mod_contracts = ContractSync("damage_mods", fetch_contracts, build_damage_mods)
+
+
+@cached(maxsize=256, ttl=60, stale_ttl=900)
+async def get_abyssals_mutamarket(type_id: int, type_name: str):
+    """Fetch all abyssals from a certain type from the mutamarket API, only parsing contracts that changed"""
+    return await damage_mod_contracts.sync(type_id, type_name)
 
 
 async def fetch_module_prices(modules):
@@ -184,45 +206,427 @@ def module_combinations(repeatable_mods, unique_mods, count) -> Generator[list[A
                 yield [m] + y
 
 
-def should_filter_module(module: DamageMod, all_modules: list[DamageMod], max_price: float):
-    """Helper function for filter_modules"""
-    # Remove modules outside of max price
-    if module.price > max_price:
-        return True
+class _PrefixMax:
+    """Fenwick tree holding the highest value stored at or below every position"""
+
+    def __init__(self, size):
+        self.tree = [-math.inf] * (size + 1)
+        self.touched = []
+
+    def update(self, position, value):
+        i = position + 1
+        while i < len(self.tree):
+            if value > self.tree[i]:
+                self.tree[i] = value
+                self.touched.append(i)
+            i += i & -i
+
+    def query(self, position):
+        best = -math.inf
+        i = position + 1
+        while i > 0:
+            best = max(best, self.tree[i])
+            i -= i & -i
+        return best
+
+    def clear(self):
+        for i in self.touched:
+            self.tree[i] = -math.inf
+        self.touched.clear()
+
+
+# Largest skyline the sweep compares every module against before switching to divide and conquer
+SWEEP_LIMIT = 256
+
+
+def _sweep(modules, by_price):
+    """Compares every module with the undominated strictly cheaper ones, None once there are too many of those"""
+    dominated = [False] * len(modules)
+    kept = []
+    group = []
+    for position, i in enumerate(by_price):
+        module = modules[i]
+        for index, other in enumerate(kept):
+            if other.cpu <= module.cpu and other.rof <= module.rof and other.damage >= module.damage:
+                dominated[i] = True
+                # Strong modules mark many others, checking them first ends most comparisons early
+                if index:
+                    kept.insert(0, kept.pop(index))
+                break
+        else:
+            group.append(module)
+
+        # Modules of the same price only count against more expensive ones
+        if position + 1 == len(by_price) or modules[by_price[position + 1]].price != module.price:
+            kept.extend(group)
+            group.clear()
+            if len(kept) > SWEEP_LIMIT:
+                return None
+    return dominated
+
+
+def skyline(modules: list[DamageMod], epsilon: float = 0.0) -> list[bool]:
+    """Marks every module that some strictly cheaper module beats or matches in cpu, rate of fire and damage.
+
+    Most modules are usually beaten by a few cheap ones, so the modules are first swept by price against the
+    unmarked cheaper ones. Once more than SWEEP_LIMIT of those pile up, or with `epsilon`, it is divide and
+    conquer over the modules sorted by price, O(n log² n): the cheaper half of every range is swept by cpu
+    against the more expensive half, with a Fenwick tree over rate of fire holding the best damage.
+    Modules of the same price never mark each other. With `epsilon`, a cheaper module that is at most that much
+    worse in any stat, relatively, marks a module as well.
+    """
+    count = len(modules)
+    by_price = sorted(range(count), key=lambda i: modules[i].price)
+    # Without a tolerance, beating a marked module means beating the module that marked it as well
+    if not epsilon and (dominated := _sweep(modules, by_price)) is not None:
+        return dominated
+
+    dominated = [False] * count
+    prices = [modules[i].price for i in by_price]
+    rofs = sorted({m.rof for m in modules})
+    rof_rank = {rof: rank for rank, rof in enumerate(rofs)}
+    best_damage = _PrefixMax(len(rofs))
+
+    def cross(cheaper, pricier):
+        # Cheaper modules go first on equal cpu, as being equal is good enough
+        events = [(modules[i].cpu, 0, i) for i in cheaper] + [(modules[i].cpu * (1 + epsilon), 1, i) for i in pricier]
+        for _, pricier_one, i in sorted(events):
+            module = modules[i]
+            if not pricier_one:
+                best_damage.update(rof_rank[module.rof], module.damage)
+            elif best_damage.query(bisect.bisect_right(rofs, module.rof * (1 + epsilon)) - 1) >= module.damage * (1 - epsilon):
+                dominated[i] = True
+        best_damage.clear()
+
+    def solve(start, end):
+        # Split between two prices, as close to the middle as possible
+        middle = (start + end) // 2
+        splits = [
+            split for split in (
+                bisect.bisect_left(prices, prices[middle], start, end),
+                bisect.bisect_right(prices, prices[middle], start, end)
+            ) if start < split < end
+        ]
+        if not splits:
+            return
+        split = min(splits, key=lambda s: abs(s - middle))
 
-    for other_module in all_modules:
+        solve(start, split)
+        solve(split, end)
+        cross(by_price[start:split], by_price[split:end])
 
-        # Remove strictly worse modules
-        if (module.cpu >= other_module.cpu and
-                module.rof >= other_module.rof and
-                module.damage <= other_module.damage and
-                module.price > other_module.price):
-            return True
+    if count:
+        solve(0, count)
+    return dominated
 
-    return False
 
+def filter_modules(modules: list[DamageMod], max_price: float, epsilon: float = 0.0) -> list[DamageMod]:
+    """filter out any modules above max price or strictly worse than some other module, keeping their order"""
+    modules = [m for m in modules if m.price <= max_price]
+    return [m for m, dominated in zip(modules, skyline(modules, epsilon)) if not dominated]
 
-def filter_modules(modules: list[DamageMod], max_price: float) -> list[DamageMod]:
-    """filter out any modules that are strictly worse than some other modules"""
 
-    modules_to_remove = [m for m in modules if should_filter_module(m, modules, max_price)]
+# Abyssal modules of each type that no cheaper one beats, kept up to date from the contract changes
+unique_skylines = {}
 
-    modules = list(set(modules) - set(modules_to_remove))
 
-    return modules
+def update_skyline(type_id, diff):
+    """Updates the skyline of `type_id` with a ContractDiff, only checking new modules against the old skyline.
 
+    A module is only ever beaten by cheaper ones, so below any max price the skyline of all modules is the
+    part of this skyline below it. Only removing a module of the skyline means checking all modules again.
+    """
+    gone = {id(m) for m in diff.removed} | {id(old) for old, _ in diff.changed}
+    # Taken out until the update is done, so after a failed one the next starts from all modules again
+    current = unique_skylines.pop(type_id, None)
+    if current is None or any(id(m) in gone for m in current):
+        candidates = damage_mod_contracts.indexes[type_id].values()
+    else:
+        candidates = current + diff.added + [new for _, new in diff.changed]
+    unique_skylines[type_id] = [m for m, dominated in zip(candidates, skyline(candidates)) if not dominated]
 
-def best_sets(
-        unique_mods,
-        repeatable_mods,
-        count,
-        min_price,
-        max_price,
-        max_cpu,
-        results=5,
-        **kwargs
-) -> Generator[tuple[DamageModSet, Any], Any, None]:
-    """return the best module sets based on all possible module sets, as well as their relative grading"""
+
+damage_mod_contracts.subscribe(update_skyline)
+
+
+class _Frontier:
+    """Pareto frontier of (price, damage multiplier) points, where every cheaper point has less damage"""
+
+    def __init__(self):
+        self.prices = []
+        self.damages = []
+
+    def best_damage(self, price):
+        """Highest damage of any point costing at most `price`"""
+        index = bisect.bisect_right(self.prices, price)
+        return self.damages[index - 1] if index else -math.inf
+
+    def add(self, price, damage):
+        if self.best_damage(price) >= damage:
+            return
+
+        # Drop the points that cost at least as much and do no more damage
+        start = end = bisect.bisect_left(self.prices, price)
+        while end < len(self.damages) and self.damages[end] <= damage:
+            end += 1
+        self.prices[start:end] = [price]
+        self.damages[start:end] = [damage]
+
+    def points(self):
+        return list(zip(self.prices, self.damages))
+
+
+class SetSearch:
+    """Branch and bound search over all sets of `count` modules below `max_cpu`.
+
+    Modules are explored in order of damage per rate of fire, so strong sets are found early. Stacking penalties
+    only ever shrink with more modules, so filling the open slots of a partial set with the best damage and rate
+    of fire still available bounds the multiplier of every set it can grow into.
+    """
+
+    def __init__(self, unique_mods, repeatable_mods, count, max_cpu, max_nodes=5_000_000, uptime=1, rof_rig="",
+                 damage_rig="", leading=None, stop_at=None):
+        candidates = [(m, True) for m in repeatable_mods] + [(m, False) for m in unique_mods]
+        candidates.sort(key=lambda c: c[0].damage / c[0].rof, reverse=True)
+
+        self.mods = [m for m, _ in candidates]
+        self.repeatable = [r for _, r in candidates]
+        self.cpu = [m.cpu for m in self.mods]
+        self.price = [m.price for m in self.mods]
+        self.damage = [m.damage for m in self.mods]
+        self.rof = [m.rof for m in self.mods]
+
+        self.count = count
+        self.max_cpu = max_cpu
+        self.max_nodes = max_nodes
+        self.nodes = 0
+        # Indices the first module of a set is taken from, None for all, so shards can search parts of all sets
+        self.leading = leading
+        # Wall clock time to give up at, None to search for as long as it takes
+        self.stop_at = stop_at
+        self.uptime = uptime
+        self.damage_rigs, self.rof_rigs = DamageModSet.rig_bonuses(rof_rig, damage_rig)
+
+        # Best stats any module from an index onwards has, the last entry is for no modules left at all
+        self.max_damage = self._suffix(self.damage, max, -math.inf)
+        self.min_rof = self._suffix(self.rof, min, math.inf)
+        self.min_cpu = self._suffix(self.cpu, min, math.inf)
+        self.min_price = self._suffix(self.price, min, math.inf)
+
+    @staticmethod
+    def _suffix(values, best, empty):
+        suffix = [empty]
+        for value in reversed(values):
+            suffix.append(best(value, suffix[-1]))
+        return suffix[::-1]
+
+    def multiplier(self, damages, rofs):
+        return DamageModSet.combined_multiplier(damages + self.damage_rigs, rofs + self.rof_rigs, self.uptime)
+
+    def bound(self, damages, rofs, start, left):
+        """Cheapest price and highest multiplier `left` more modules from index `start` onwards can add"""
+        return (
+            left * self.min_price[start],
+            self.multiplier(damages + [self.max_damage[start]] * left, rofs + [self.min_rof[start]] * left)
+        )
+
+    def search(self, prune, visit):
+        """Calls `visit(indices, cpu, price, multiplier)` for every set whose partial sets `prune` did not cut off.
+
+        `prune(price, start, left, damages, rofs)` gets a partial set with `left` open slots,
+        to be filled with modules from index `start` onwards.
+        """
+        chosen, damages, rofs = [], [], []
+
+        def descend(start, cpu, price):
+            self.nodes += 1
+            if self.nodes > self.max_nodes:
+                raise ValueError("There are too many promising combinations, narrow down the search!")
+            if self.stop_at is not None and self.nodes % 10_000 == 0 and time.time() > self.stop_at:
+                raise DeadlineExceeded("No time left to finish the search.")
+
+            left = self.count - len(chosen)
+            if left == 0:
+                visit(chosen, cpu, price, self.multiplier(damages, rofs))
+                return
+
+            first = self.leading if not chosen and self.leading is not None else range(start, len(self.mods))
+            for i in first:
+                set_cpu = cpu + self.cpu[i]
+                # Repeatable modules can be taken again, unique ones only once
+                next_start = i if self.repeatable[i] else i + 1
+                if (set_cpu + self.min_cpu[next_start] * (left - 1) if left > 1 else set_cpu) >= self.max_cpu:
+                    continue
+
+                chosen.append(i)
+                damages.append(self.damage[i])
+                rofs.append(self.rof[i])
+                set_price = price + self.price[i]
+                if left == 1 or not prune(set_price, next_start, left - 1, damages, rofs):
+                    descend(next_start, set_cpu, set_price)
+                chosen.pop()
+                damages.pop()
+                rofs.pop()
+
+        descend(0, 0, 0)
+
+    def frontier(self):
+        """Pareto frontier of price and multiplier of all sets, which is all RelationalSorter needs"""
+        frontier = _Frontier()
+
+        def prune(price, start, left, damages, rofs):
+            extra_price, best = self.bound(damages, rofs, start, left)
+            return frontier.best_damage(price + extra_price) >= best
+
+        self.search(prune, lambda indices, cpu, price, multiplier: frontier.add(price, multiplier))
+        return frontier
+
+    def subtree_sizes(self):
+        """Upper bound on the number of sets starting with each module, used to split the search evenly"""
+        sizes = []
+        for i in range(len(self.mods)):
+            rest = len(self.mods) - (i if self.repeatable[i] else i + 1)
+            sizes.append(math.comb(rest + self.count - 2, self.count - 1) if self.count > 1 else 1)
+        return sizes
+
+    def best(self, sorter, min_price, max_price, results, floor=-math.inf):
+        """Sets in the price range with the best efficiency according to `sorter`, best first
+
+        Sets below the efficiency `floor` are skipped, e.g. when other sets already known are at least that good.
+        """
+        heap = []
+        order = itertools.count()
+
+        def prune(price, start, left, damages, rofs):
+            extra_price, best = self.bound(damages, rofs, start, left)
+            if price + extra_price >= max_price:
+                return True
+            # The upper hull of the sorter grows with the price, so the cheapest price gives the highest efficiency
+            efficiency = sorter((price + extra_price, best))
+            return efficiency < floor or len(heap) == results and efficiency <= heap[0][0]
+
+        def visit(indices, cpu, price, multiplier):
+            if not min_price < price < max_price or (efficiency := sorter((price, multiplier))) < floor:
+                return
+            entry = (efficiency, -next(order), list(indices), price, multiplier)
+            if len(heap) < results:
+                heapq.heappush(heap, entry)
+            elif entry[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, entry)
+
+        if results > 0:
+            self.search(prune, visit)
+        return [
+            (DamageModSet([self.mods[i] for i in indices]), efficiency)
+            for efficiency, _, indices, _, _ in sorted(heap, reverse=True)
+        ]
+
+
+class SetArrays:
+    """Evaluates all sets of `count` modules below `max_cpu` in chunks of index arrays with numpy.
+
+    Every row of a chunk holds the indices of the modules of one set, so sorting by stacking order, stacking
+    penalties and rigs are all done for `chunk_size` sets at once, which also caps the memory used.
+    """
+
+    def __init__(self, unique_mods, repeatable_mods, count, max_cpu, chunk_size=100_000, uptime=1, rof_rig="",
+                 damage_rig=""):
+        self.mods = list(repeatable_mods) + list(unique_mods)
+        self.repeatables = len(repeatable_mods)
+        self.cpu = np.array([m.cpu for m in self.mods], dtype=float)
+        self.price = np.array([m.price for m in self.mods], dtype=float)
+        self.damage = np.array([m.damage for m in self.mods], dtype=float)
+        self.rof = np.array([m.rof for m in self.mods], dtype=float)
+
+        self.count = count
+        self.max_cpu = max_cpu
+        self.chunk_size = chunk_size
+        self.uptime = uptime
+        self.damage_rigs, self.rof_rigs = DamageModSet.rig_bonuses(rof_rig, damage_rig)
+        self.penalties = np.array(DamageModSet.penalties)
+
+    def chunks(self):
+        """Yields index arrays of all sets, repeatable modules can be taken many times and unique ones once"""
+        uniques = range(self.repeatables, len(self.mods))
+
+        for repeated in range(self.count, -1, -1):
+            heads = list(itertools.combinations_with_replacement(range(self.repeatables), repeated))
+            if not heads:
+                continue
+            heads = np.array(heads, dtype=np.intp).reshape(len(heads), repeated)
+
+            left = self.count - repeated
+            if left == 0:
+                yield heads
+                continue
+
+            tails = itertools.combinations(uniques, left)
+            rows = max(1, self.chunk_size // len(heads))
+            while len(tail := np.fromiter(
+                    itertools.chain.from_iterable(itertools.islice(tails, rows)), dtype=np.intp
+            ).reshape(-1, left)):
+                yield np.hstack([np.repeat(heads, len(tail), axis=0), np.tile(tail, (len(heads), 1))])
+
+    def _stack(self, values, rigs, reverse):
+        if rigs:
+            values = np.hstack([values, np.broadcast_to(rigs, (len(values), len(rigs)))])
+        values = np.sort(values, axis=1)
+        if reverse:
+            values = values[:, ::-1]
+        return np.prod(1 + (values - 1) * self.penalties[:values.shape[1]], axis=1)
+
+    def evaluate(self, indices):
+        """Returns the indices, prices and multipliers of the sets of a chunk that fit into max_cpu"""
+        indices = indices[self.cpu[indices].sum(axis=1) < self.max_cpu]
+
+        damage_increase = self._stack(self.damage[indices], self.damage_rigs, reverse=True)
+        rof_time_decrease = self._stack(self.rof[indices], self.rof_rigs, reverse=False)
+        multipliers = damage_increase / (self.uptime * rof_time_decrease + (1 - self.uptime))
+
+        return indices, self.price[indices].sum(axis=1), multipliers
+
+    @staticmethod
+    def _pareto(prices, multipliers):
+        # Cheapest first and the highest multiplier first among equal prices, then keep the ones beating all before
+        order = np.lexsort((-multipliers, prices))
+        prices, multipliers = prices[order], multipliers[order]
+        best_before = np.maximum.accumulate(np.concatenate([[-np.inf], multipliers[:-1]]))
+        keep = multipliers > best_before
+        return prices[keep], multipliers[keep]
+
+    def frontier(self):
+        """Pareto frontier of price and multiplier of all sets, which is all RelationalSorter needs"""
+        prices, multipliers = np.empty(0), np.empty(0)
+        for chunk in self.chunks():
+            _, chunk_prices, chunk_multipliers = self.evaluate(chunk)
+            prices, multipliers = self._pareto(
+                np.concatenate([prices, chunk_prices]), np.concatenate([multipliers, chunk_multipliers])
+            )
+        return list(zip(prices.tolist(), multipliers.tolist()))
+
+    def best(self, sorter, min_price, max_price, results):
+        """Sets in the price range with the best efficiency according to `sorter`, best first"""
+        best_indices = np.empty((0, self.count), dtype=np.intp)
+        best_scores = np.empty(0)
+        for chunk in self.chunks():
+            indices, prices, multipliers = self.evaluate(chunk)
+            usable = (min_price < prices) & (prices < max_price)
+            scores = sorter.score_many(prices[usable], multipliers[usable])
+
+            best_indices = np.concatenate([best_indices, indices[usable]])
+            best_scores = np.concatenate([best_scores, scores])
+            if len(best_scores) > results:
+                keep = np.argpartition(-best_scores, results - 1)[:results] if results > 0 else []
+                best_indices, best_scores = best_indices[keep], best_scores[keep]
+
+        order = np.argsort(-best_scores, kind="stable")
+        return [
+            (DamageModSet([self.mods[i] for i in best_indices[row]]), float(best_scores[row]))
+            for row in order
+        ]
+
+
+def _exhaustive_sets(unique_mods, repeatable_mods, count, min_price, max_price, max_cpu, results, **kwargs):
     sorting_points = []
     usable_sets = []
 
@@ -243,16 +647,107 @@ def best_sets(
             usable_sets.append((damage_mod_set, price, damage_multiplier))
 
     sorter = RelationalSorter(sorting_points)
+    scores = sorter.score_many([c[1] for c in usable_sets], [c[2] for c in usable_sets])
 
     # Use heapq.nlargest instead of sorting everything
-    best_sets = heapq.nlargest(
-        results,
-        usable_sets,
-        key=lambda c: sorter((c[1], c[2]))  # Using precomputed values
-    )
+    best_sets = heapq.nlargest(results, range(len(usable_sets)), key=lambda i: scores[i])
+
+    return [(usable_sets[i][0], float(scores[i])) for i in best_sets]
 
-    for damage_mod_set, price, damage_multiplier in best_sets:
-        yield damage_mod_set, sorter((price, damage_multiplier))
+
+def _branch_and_bound_sets(unique_mods, repeatable_mods, count, min_price, max_price, max_cpu, results, **kwargs):
+    search = SetSearch(unique_mods, repeatable_mods, count, max_cpu, **kwargs)
+    # Only sets on the Pareto frontier can be on the upper hull the sorter grades against
+    if not (points := search.frontier().points()):
+        return []
+    sorter = RelationalSorter(points)
+    return search.best(sorter, min_price, max_price, results)
+
+
+def _numpy_sets(unique_mods, repeatable_mods, count, min_price, max_price, max_cpu, results, **kwargs):
+    sets = SetArrays(unique_mods, repeatable_mods, count, max_cpu, **kwargs)
+    if not (points := sets.frontier()):
+        return []
+    return sets.best(RelationalSorter(points), min_price, max_price, results)
+
+
+def _frontier(search):
+    return search.frontier().points(), search.nodes
+
+
+def _shard_best(shard, search, sorter, min_price, max_price, results, floor):
+    search.leading, search.max_nodes = shard
+    return search.best(sorter, min_price, max_price, results, floor)
+
+
+# Searches expected to visit fewer sets than this are not worth starting more than one process for
+SERIAL_LIMIT = 200_000
+
+
+async def best_sets_parallel(
+        unique_mods, repeatable_mods, count, min_price, max_price, max_cpu, results=5, engine="branch_and_bound",
+        max_nodes=5_000_000, **kwargs
+):
+    """best_sets in worker processes, with the branch_and_bound engine searching shards of the sets in parallel.
+
+    The Pareto frontier is found by one process first. The best sets on it give every shard the efficiency the
+    final sets have to reach at least, so shards prune as much as the serial search does. The sets are split by
+    their first module into shards of about the same size, which share the node budget left by the frontier.
+    """
+    stop_at = parallel.stop_at()
+    if engine != "branch_and_bound":
+        return await parallel.run(
+            best_sets, unique_mods, repeatable_mods, count, min_price, max_price, max_cpu, results, engine, **kwargs
+        )
+
+    search = SetSearch(unique_mods, repeatable_mods, count, max_cpu, max_nodes=max_nodes, stop_at=stop_at, **kwargs)
+    sizes = search.subtree_sizes()
+    if parallel.WORKERS == 1 or sum(sizes) < SERIAL_LIMIT:
+        return await parallel.run(_branch_and_bound_sets, unique_mods, repeatable_mods, count, min_price, max_price,
+                                  max_cpu, results, max_nodes=max_nodes, stop_at=stop_at, **kwargs)
+
+    points, nodes = await parallel.run(_frontier, search)
+    if not points:
+        return []
+    sorter = RelationalSorter(points)
+
+    # Every frontier point is a set, so the best sets are at least as good as the best points in the price range
+    scores = sorted((sorter(point) for point in points if min_price < point[0] < max_price), reverse=True)
+    floor = scores[results - 1] if 0 < results <= len(scores) else -math.inf
+
+    shards = parallel.balanced(sizes, parallel.WORKERS * 4)
+    total = sum(sizes)
+    shards = [(leading, max(1, (max_nodes - nodes) * sum(sizes[i] for i in leading) // total)) for leading in shards]
+    shard_sets = await parallel.map_shards(_shard_best, shards, search, sorter, min_price, max_price, results, floor)
+    return heapq.nlargest(results, itertools.chain.from_iterable(shard_sets), key=lambda s: s[1])
+
+
+ENGINES = {
+    "exhaustive": _exhaustive_sets,
+    "branch_and_bound": _branch_and_bound_sets,
+    "numpy": _numpy_sets,
+}
+
+
+def best_sets(
+        unique_mods,
+        repeatable_mods,
+        count,
+        min_price,
+        max_price,
+        max_cpu,
+        results=5,
+        engine="branch_and_bound",
+        **kwargs
+) -> list[tuple[DamageModSet, float]]:
+    """return the best module sets based on all possible module sets, as well as their relative grading
+
+    The exhaustive engine evaluates every set, branch_and_bound finds the same sets while skipping
+    everything that can not beat them, and numpy evaluates every set but many thousands at once.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine {engine}, use one of {', '.join(ENGINES)}")
+    return ENGINES[engine](unique_mods, repeatable_mods, count, min_price, max_price, max_cpu, results, **kwargs)
 
 
 async def send_best(interaction, args, unique_mods, repeatable_mods):
@@ -273,27 +768,28 @@ async def send_best(interaction, args, unique_mods, repeatable_mods):
     unique_mods = filter_modules(unique_mods, max_price)
     repeatable_mods = filter_modules(repeatable_mods, max_price)
 
-    # Return early if there are to many combinations
-    total_combinations = (len(unique_mods) + len(repeatable_mods)) ** slots
+    # Return early if there are to many combinations, the search skips most of them but not all
+    total_combinations = sum(
+        math.comb(len(repeatable_mods) + repeated - 1, repeated) * math.comb(len(unique_mods), slots - repeated)
+        if repeated else math.comb(len(unique_mods), slots)
+        for repeated in range(slots + 1)
+    )
 
-    if total_combinations > 8e8:
+    if total_combinations > 1e15:
         await interaction.followup.send(
             f"There are approximately {total_combinations} combinations - to many for the bot to handle!\n "
             "Consider reducing the price range or amount of slots.")
         return
-    elif total_combinations > 1e8:
-        await interaction.followup.send(
-            f"This might take a while, there are approximately {total_combinations} combinations!")
 
     # Find sets
-    loop = asyncio.get_running_loop()
-    sets = await loop.run_in_executor(
-        None, functools.partial(
-            best_sets,
+    try:
+        sets = await best_sets_parallel(
             unique_mods, repeatable_mods, slots, min_price, max_price, max_cpu, count,
             uptime=uptime, rof_rig=rof_rig, damage_rig=damage_rig
         )
-    )
+    except ValueError as e:
+        await interaction.followup.send(f"{e}\n Consider reducing the price range or amount of slots.")
+        return
 
     # Make printout
     has_set = False
@@ -305,6 +801,77 @@ async def send_best(interaction, args, unique_mods, repeatable_mods):
         await interaction.followup.send("No combinations found for these requirements!")
 
 
+# Abyssal type and regular modules (type_id, name, cpu, damage, rof) of every damage mod family
+DAMAGE_MOD_FAMILIES = {
+    "ballistics": (49738, "Abyssal Ballistics Control System", [
+        (21484, "'Full Duplex' Ballistic Control System", 22, 1.10, 0.9),
+        (12274, "Ballistic Control System I", 35, 1.07, 0.92),
+        (16457, "Crosslink Compact Ballistic Control System", 31, 1.08, 0.90),
+        (22291, "Ballistic Control System II", 40, 1.1, 0.90),
+        (46270, "Kaatara's Custom Ballistic Control System", 38, 1.1, 0.90),
+        (15681, "Caldari Navy Ballistic Control System", 24, 1.12, 0.89),
+        (13935, "Domination Ballistic Control System", 24, 1.12, 0.89),
+        (13937, "Dread Guristas Ballistic Control System", 24, 1.12, 0.89),
+        (28563, "Khanid Navy Ballistic Control System", 24, 1.12, 0.89),
+        (15683, "Republic Fleet Ballistic Control System", 24, 1.12, 0.89),
+    ]),
+    "entropics": (49734, "Abyssal Entropic Radiation Sink", [
+        (47908, "Entropic Radiation Sink I", 27, 1.09, 0.96),
+        (47909, "Compact Entropic Radiation Sink", 25, 1.10, 0.95),
+        (47911, "Entropic Radiation Sink II", 30, 1.13, 0.94),
+        (52244, "Veles Entropic Radiation Sink", 23, 1.14, 0.93),
+    ]),
+    "gyros": (49730, "Abyssal Gyrostabilizer", [
+        (518, "'Basic' Gyrostabilizer", 16.0, 1.07, 0.93),
+        (519, "Gyrostabilizer II", 30.0, 1.10, 0.90),
+        (520, "Gyrostabilizer I", 27.0, 1.07, 0.92),
+        (21486, "'Kindred' Gyrostabilizer", 18.0, 1.10, 0.90),
+        (5933, "Counterbalanced Compact Gyrostabilizer", 25.0, 1.08, 0.90),
+        (13939, "Domination Gyrostabilizer", 20.0, 1.12, 0.89),
+        (15806, "Republic Fleet Gyrostabilizer", 20.0, 1.12, 0.89),
+    ]),
+    "heatsinks": (49726, "Abyssal Heat Sink", [
+        (2363, "Heat Sink I", 35.0, 1.07, 0.92),
+        (5849, "Extruded Compact Heat Sink", 25.0, 1.08, 0.90),
+        (2364, "Heat Sink II", 30.0, 1.1, 0.90),
+        (1893, "'Basic' Heat Sink", 16.0, 1.07, 0.93),
+        (23902, "'Trebuchet' Heat Sink I", 18.0, 1.1, 0.9),
+        (44111, "Tahron's Custom Heat Sink", 29.0, 1.1, 0.9),
+        (15810, "Imperial Navy Heat Sink", 20.0, 1.12, 0.89),
+        (13943, "True Sansha Heat Sink", 20.0, 1.12, 0.89),
+        (15808, "Ammatar Navy Heat Sink", 20.0, 1.12, 0.89),
+    ]),
+    "magstabs": (49722, "Abyssal Magnetic Field Stabilizer", [
+        (9944, "Magnetic Field Stabilizer I", 35.0, 1.07, 0.92),
+        (10190, "Magnetic Field Stabilizer II", 30.0, 1.10, 0.90),
+        (10188, "'Basic' Magnetic Field Stabilizer", 16.0, 1.07, 0.93),
+        (22919, "'Monopoly' Magnetic Field Stabilizer", 18.0, 1.10, 0.90),
+        (44113, "Kaatara's Custom Magnetic Field Stabilizer", 29.0, 1.10, 0.90),
+        (44114, "Torelle's Custom Magnetic Field Stabilizer", 29.0, 1.10, 0.90),
+        (15416, "Naiyon's Modified Magnetic Field Stabilizer", 24.0, 1.14, 0.90),
+        (15895, "Federation Navy Magnetic Field Stabilizer", 20.0, 1.12, 0.89),
+        (13945, "Shadow Serpentis Magnetic Field Stabilizer", 20.0, 1.12, 0.89),
+    ]),
+}
+
+
+def repeatable_mods(family) -> list[DamageMod]:
+    return [
+        DamageMod(type_id, type_name, cpu=cpu, damage=damage, rof=rof)
+        for type_id, type_name, cpu, damage, rof in DAMAGE_MOD_FAMILIES[family][2]
+    ]
+
+
+async def send_family(interaction, args, family):
+    abyssal_type_id, abyssal_name, _ = DAMAGE_MOD_FAMILIES[family]
+    unique_mods = await get_abyssals_mutamarket(abyssal_type_id, abyssal_name)
+    unique_mods = unique_skylines.get(abyssal_type_id, unique_mods)
+
+    repeatable = repeatable_mods(family)
+    await fetch_module_prices(repeatable)
+    await send_best(interaction, args, unique_mods, repeatable)
+
+
 class DamageModCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
@@ -337,56 +904,7 @@ class DamageModCog(commands.Cog):
             damage_rig: Optional[str] = None
     ):
         args = (slots, max_cpu, min_price, max_price, uptime, count, rof_rig, damage_rig)
-
-        ballistics_unique = await get_abyssals_mutamarket(
-            49738, "Abyssal Ballistics Control System"
-        )
-
-        ballistics_repeatable = [
-            DamageMod(
-                21484, "'Full Duplex' Ballistic Control System",
-                cpu=22, damage=1.10, rof=0.9
-            ),
-            DamageMod(
-                12274, "Ballistic Control System I",
-                cpu=35, damage=1.07, rof=0.92
-            ),
-            DamageMod(
-                16457, "Crosslink Compact Ballistic Control System",
-                cpu=31, damage=1.08, rof=0.90
-            ),
-            DamageMod(
-                22291, "Ballistic Control System II",
-                cpu=40, damage=1.1, rof=0.90
-            ),
-            DamageMod(
-                46270, "Kaatara's Custom Ballistic Control System",
-                cpu=38, damage=1.1, rof=0.90
-            ),
-            DamageMod(
-                15681, "Caldari Navy Ballistic Control System",
-                cpu=24, damage=1.12, rof=0.89
-            ),
-            DamageMod(
-                13935, "Domination Ballistic Control System",
-                cpu=24, damage=1.12, rof=0.89
-            ),
-            DamageMod(
-                13937, "Dread Guristas Ballistic Control System",
-                cpu=24, damage=1.12, rof=0.89
-            ),
-            DamageMod(
-                28563, "Khanid Navy Ballistic Control System",
-                cpu=24, damage=1.12, rof=0.89
-            ),
-            DamageMod(
-                15683, "Republic Fleet Ballistic Control System",
-                cpu=24, damage=1.12, rof=0.89
-            ),
-        ]
-
-        await fetch_module_prices(ballistics_repeatable)
-        await send_best(interaction, args, ballistics_unique, ballistics_repeatable)
+        await send_family(interaction, args, "ballistics")
 
     @app_commands.command(
         name="entropics",
@@ -416,32 +934,7 @@ class DamageModCog(commands.Cog):
             damage_rig: Optional[str] = None
     ):
         args = (slots, max_cpu, min_price, max_price, uptime, count, rof_rig, damage_rig)
-
-        entropics_unique = await get_abyssals_mutamarket(
-            49734, "Abyssal Entropic Radiation Sink"
-        )
-
-        entropics_repeatable = [
-            DamageMod(
-                47908, "Entropic Radiation Sink I",
-                cpu=27, damage=1.09, rof=0.96
-            ),
-            DamageMod(
-                47909, "Compact Entropic Radiation Sink",
-                cpu=25, damage=1.10, rof=0.95
-            ),
-            DamageMod(
-                47911, "Entropic Radiation Sink II",
-                cpu=30, damage=1.13, rof=0.94
-            ),
-            DamageMod(
-                52244, "Veles Entropic Radiation Sink",
-                cpu=23, damage=1.14, rof=0.93
-            ),
-        ]
-
-        await fetch_module_prices(entropics_repeatable)
-        await send_best(interaction, args, entropics_unique, entropics_repeatable)
+        await send_family(interaction, args, "entropics")
 
     @app_commands.command(
         name="gyros",
@@ -471,44 +964,7 @@ class DamageModCog(commands.Cog):
             damage_rig: Optional[str] = None
     ):
         args = (slots, max_cpu, min_price, max_price, uptime, count, rof_rig, damage_rig)
-
-        gyros_unique = await get_abyssals_mutamarket(
-            49730, "Abyssal Gyrostabilizer"
-        )
-
-        gyros_repeatable = [
-            DamageMod(
-                518, "'Basic' Gyrostabilizer",
-                cpu=16.0, damage=1.07, rof=0.93
-            ),
-            DamageMod(
-                519, "Gyrostabilizer II",
-                cpu=30.0, damage=1.10, rof=0.90
-            ),
-            DamageMod(
-                520, "Gyrostabilizer I",
-                cpu=27.0, damage=1.07, rof=0.92
-            ),
-            DamageMod(
-                21486, "'Kindred' Gyrostabilizer",
-                cpu=18.0, damage=1.10, rof=0.90,
-            ),
-            DamageMod(
-                5933, "Counterbalanced Compact Gyrostabilizer",
-                cpu=25.0, damage=1.08, rof=0.90,
-            ),
-            DamageMod(
-                13939, "Domination Gyrostabilizer",
-                cpu=20.0, damage=1.12, rof=0.89,
-            ),
-            DamageMod(
-                15806, "Republic Fleet Gyrostabilizer",
-                cpu=20.0, damage=1.12, rof=0.89,
-            ),
-        ]
-
-        await fetch_module_prices(gyros_repeatable)
-        await send_best(interaction, args, gyros_unique, gyros_repeatable)
+        await send_family(interaction, args, "gyros")
 
     @app_commands.command(
         name="heatsinks",
@@ -538,52 +994,7 @@ class DamageModCog(commands.Cog):
             damage_rig: Optional[str] = None
     ):
         args = (slots, max_cpu, min_price, max_price, uptime, count, rof_rig, damage_rig)
-
-        heatsinks_unique = await get_abyssals_mutamarket(
-            49726, "Abyssal Heat Sink"
-        )
-
-        heatsinks_repeatable = [
-            DamageMod(
-                2363, "Heat Sink I",
-                cpu=35.0, damage=1.07, rof=0.92
-            ),
-            DamageMod(
-                5849, "Extruded Compact Heat Sink",
-                cpu=25.0, damage=1.08, rof=0.90
-            ),
-            DamageMod(
-                2364, "Heat Sink II",
-                cpu=30.0, damage=1.1, rof=0.90
-            ),
-            DamageMod(
-                1893, "'Basic' Heat Sink",
-                cpu=16.0, damage=1.07, rof=0.93
-            ),
-            DamageMod(
-                23902, "'Trebuchet' Heat Sink I",
-                cpu=18.0, damage=1.1, rof=0.9
-            ),
-            DamageMod(
-                44111, "Tahron's Custom Heat Sink",
-                cpu=29.0, damage=1.1, rof=0.9,
-            ),
-            DamageMod(
-                15810, "Imperial Navy Heat Sink",
-                cpu=20.0, damage=1.12, rof=0.89
-            ),
-            DamageMod(
-                13943, "True Sansha Heat Sink",
-                cpu=20.0, damage=1.12, rof=0.89
-            ),
-            DamageMod(
-                15808, "Ammatar Navy Heat Sink",
-                cpu=20.0, damage=1.12, rof=0.89
-            ),
-        ]
-
-        await fetch_module_prices(heatsinks_repeatable)
-        await send_best(interaction, args, heatsinks_unique, heatsinks_repeatable)
+        await send_family(interaction, args, "heatsinks")
 
     @app_commands.command(
         name="magstabs",
@@ -613,53 +1024,15 @@ class DamageModCog(commands.Cog):
             damage_rig: Optional[str] = None
     ):
         args = (slots, max_cpu, min_price, max_price, uptime, count, rof_rig, damage_rig)
+        await send_family(interaction, args, "magstabs")
 
-        magstabs_unique = await get_abyssals_mutamarket(
-            49722, "Abyssal Magnetic Field Stabilizer"
-        )
-
-        magstabs_repeatable = [
-            DamageMod(
-                9944, "Magnetic Field Stabilizer I",
-                cpu=35.0, damage=1.07, rof=0.92,
-            ),
-            DamageMod(
-                10190, "Magnetic Field Stabilizer II",
-                cpu=30.0, damage=1.10, rof=0.90,
-            ),
-            DamageMod(
-                10188, "'Basic' Magnetic Field Stabilizer",
-                cpu=16.0, damage=1.07, rof=0.93,
-            ),
-            DamageMod(
-                22919, "'Monopoly' Magnetic Field Stabilizer",
-                cpu=18.0, damage=1.10, rof=0.90,
-            ),
-            DamageMod(
-                44113, "Kaatara's Custom Magnetic Field Stabilizer",
-                cpu=29.0, damage=1.10, rof=0.90,
-            ),
-            DamageMod(
-                44114, "Torelle's Custom Magnetic Field Stabilizer",
-                cpu=29.0, damage=1.10, rof=0.90,
-            ),
-            DamageMod(
-                15416, "Naiyon's Modified Magnetic Field Stabilizer",
-                cpu=24.0, damage=1.14, rof=0.90,
-            ),
-            DamageMod(
-                15895, "Federation Navy Magnetic Field Stabilizer",
-                cpu=20.0, damage=1.12, rof=0.89,
-            ),
-            DamageMod(
-                13945, "Shadow Serpentis Magnetic Field Stabilizer",
-                cpu=20.0, damage=1.12, rof=0.89,
-            ),
-        ]
 
-        await fetch_module_prices(magstabs_repeatable)
-        await send_best(interaction, args, magstabs_unique, magstabs_repeatable)
+async def _warm_family(family):
+    abyssal_type_id, abyssal_name, repeatable = DAMAGE_MOD_FAMILIES[family]
+    await get_abyssals_mutamarket.refresh(abyssal_type_id, abyssal_name)
+    await refresh_item_prices(type_id for type_id, *_ in repeatable)
 
 
 async def setup(bot):
+    prewarm.register("damage_mods", 50, DAMAGE_MOD_FAMILIES, _warm_family)
     await bot.add_cog(DamageModCog(bot))
@@ -0,0 +1,29 @@
+import io
+
+import discord
+from discord.ext import commands
+
+from metrics import metrics
+from utils import command_error_handler
+
+
+@commands.command(name="metrics")
+@commands.is_owner()
+@command_error_handler
+async def metrics_summary(ctx, full: str = ""):
+    """Shows request latency per host, cache hit ratios and the ESI error budget. Use `full` for all metrics."""
+    metrics.dump()
+
+    if full == "full":
+        await ctx.send(file=discord.File(io.BytesIO(metrics.render().encode()), filename="metrics.txt"))
+        return
+
+    summary = metrics.summary()
+    if len(summary) > 1900:
+        await ctx.send(file=discord.File(io.BytesIO(summary.encode()), filename="metrics.txt"))
+    else:
+        await ctx.send(f"```\n{summary}\n```")
+
+
+async def setup(bot):
+    bot.add_command(metrics_summary)
@@ -2,7 +2,7 @@ from datetime import datetime, timedelta, UTC
 
 from discord.ext import commands
 
-from network import id_lookup, fetch_kill_until
+from network import id_lookup, fetch_kill_until, killmail_store
 from utils import unix_style_arg_parser, command_error_handler
 
 
@@ -24,18 +24,18 @@ async def blobfactor(ctx, *args):
 
     if "alliance" in arguments or "a" in arguments:
         name = " ".join(arguments["a"] if "a" in arguments else arguments["alliance"])
-        id = id_lookup(name, 'alliances')
-        url = f"https://zkillboard.com/api/kills/allianceID/{id}/kills/"
+        id = await id_lookup(name, 'alliances')
+        url = f"https://zkillboard.com/api/allianceID/{id}"
         days = alliance_days
     elif "corporation" in arguments or "c" in arguments:
         name = " ".join(arguments["c"] if "c" in arguments else arguments["corporation"])
-        id = id_lookup(name, 'corporations')
-        url = f"https://zkillboard.com/api/kills/corporationID/{id}/kills/"
+        id = await id_lookup(name, 'corporations')
+        url = f"https://zkillboard.com/api/corporationID/{id}"
         days = corporation_days
     else:
         name = " ".join(arguments[""])
-        id = id_lookup(name, 'characters')
-        url = f"https://zkillboard.com/api/kills/characterID/{id}/kills/"
+        id = await id_lookup(name, 'characters')
+        url = f"https://zkillboard.com/api/characterID/{id}"
         days = character_days
 
     if "days" in arguments:
@@ -49,27 +49,46 @@ async def blobfactor(ctx, *args):
         until = datetime(2003, 5, 6, 0, 0)  # Eve release date
         days = (datetime.now(UTC) - until).days
 
+    # Attacker corporations on each kill and loss
     friendlies = []
-    kills = []
-    async for kill in await fetch_kill_until(f"{url}/kills/", until):
-        kills.append(kill)
-        friendlies.extend(kill['attackers'])
-
+    kills = 0
     enemies = []
-    losses = []
-    async for loss in await fetch_kill_until(f"{url}/losses/", until):
-        losses.append(loss)
-        enemies.extend(loss['attackers'])
+    losses = 0
+
+    # Days stored completely in the local killmail store are scanned there, only newer kills are fetched
+    fetch_from = until
+    if killmail_store is not None:
+        fetch_from = await killmail_store.run(killmail_store.complete_until, until)
+
+        def scan_local(local_end):
+            kills = losses = 0
+            for partition, index, _ in killmail_store.kills(id, until, local_end):
+                kills += 1
+                friendlies.extend(partition.attacker_corporations[row] for row in partition.attackers(index))
+            for partition, index in killmail_store.losses(id, until, local_end):
+                losses += 1
+                enemies.extend(partition.attacker_corporations[row] for row in partition.attackers(index))
+            return kills, losses
+
+        kills, losses = await killmail_store.run(scan_local, fetch_from - timedelta(seconds=1))
+
+    async for kill in fetch_kill_until(f"{url}/kills/", fetch_from):
+        kills += 1
+        friendlies.extend(a.get("corporation_id", 0) for a in kill['attackers'])
+
+    async for loss in fetch_kill_until(f"{url}/losses/", fetch_from):
+        losses += 1
+        enemies.extend(a.get("corporation_id", 0) for a in loss['attackers'])
 
     if "thirdparty" in arguments and arguments["thirdparty"] == ["no"]:  # WTF is this!?
-        friendlies = [f for f in friendlies if "corporation_id" in f and f["corporation_id"] == 98633005]
-        enemies = [e for e in enemies if "corporation_id" in e and e["corporation_id"] != 98633005]
+        friendlies = [f for f in friendlies if f == 98633005]
+        enemies = [e for e in enemies if e and e != 98633005]
 
     await ctx.send(
-        f"**{name}'s last {days} days ** (analyzed {len(kills)} kills and {len(losses)} losses) \n"
-        f"Average Pilots on kill: {len(friendlies) / len(kills) :.2f}\n"
-        f"Average Enemies on loss: {len(enemies) / len(losses) :.2f}\n"
-        f"Blob Factor: {len(friendlies) / len(kills) * len(losses) / len(enemies) :.2f}"
+        f"**{name}'s last {days} days ** (analyzed {kills} kills and {losses} losses) \n"
+        f"Average Pilots on kill: {len(friendlies) / kills :.2f}\n"
+        f"Average Enemies on loss: {len(enemies) / losses :.2f}\n"
+        f"Blob Factor: {len(friendlies) / kills * losses / len(enemies) :.2f}"
     )
 
 
@@ -1,9 +1,6 @@
 import asyncio
-import ssl
 from datetime import datetime, timedelta, UTC
 
-import aiohttp
-import certifi
 from discord.ext import commands
 
 from network import id_lookup, fetch_kill_until, get_character_corporation, get_corp_name, get_corp_member_count
@@ -15,8 +12,9 @@ async def get_corp_statistics(corporation_id):
 
     # Gather Data from API
     url = f"https://zkillboard.com/api/kills/corporationID/{corporation_id}"
-    kills = await fetch_kill_until(f"{url}/kills/", datetime.now(UTC) - timedelta(days=days))
-    losses = await fetch_kill_until(f"{url}/losses/", datetime.now(UTC) - timedelta(days=days))
+    start = datetime.now(UTC) - timedelta(days=days)
+    kills = [kill async for kill in fetch_kill_until(f"{url}/kills/", start)]
+    losses = [loss async for loss in fetch_kill_until(f"{url}/losses/", start)]
 
     # Count Friendlies
     friendlies = 0
@@ -103,15 +101,13 @@ async def get_corp_statistics(corporation_id):
         if "character_id" in loss['victim']:
             character_set.add(loss['victim']["character_id"])
 
-    ssl_context = ssl.create_default_context(cafile=certifi.where())
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=ssl_context)) as session:
-        # Count characters that are in this corp
-        tasks = [get_character_corporation(character, session) for character in character_set]
-        character_corps = await asyncio.gather(*tasks)
-        active_characters = sum([1 for c in character_corps if (c == corporation_id)])
+    # Count characters that are in this corp
+    tasks = [get_character_corporation(character) for character in character_set]
+    character_corps = await asyncio.gather(*tasks)
+    active_characters = sum([1 for c in character_corps if (c == corporation_id)])
 
-        name = await get_corp_name(corporation_id, session)
-        total_characters = await get_corp_member_count(corporation_id, session)
+    name = await get_corp_name(corporation_id)
+    total_characters = await get_corp_member_count(corporation_id)
     return f"**{name}'s last {days} Days** \n Timezone: {timezone_string} \n Active Characters: {active_characters}/{total_characters} \n Average Nanos on Ships: {avg_nanos:.2f}\n Average Fleet Size on Killmail: {avg_friendlies:.2f} \n Average Enemy Fleet Size on Killmail: {avg_enemies:.2f} \n Blob Factor: {avg_friendlies / avg_enemies:.2f}"
 
 
@@ -122,7 +118,7 @@ async def corp(ctx, *args):
     !corp <corporation_name> | <corporation_id>
     """
     name = " ".join(args)
-    id = id_lookup(name, 'corporations')
+    id = await id_lookup(name, 'corporations')
 
     response = await get_corp_statistics(id)
     await ctx.send(response)
@@ -1,12 +1,15 @@
 import asyncio
+import heapq
 import itertools
 
-from async_lru import alru_cache
 from discord import app_commands, Interaction
 from discord.ext import commands
 
-from network import get_item_name, get_item_price, get_dogma_attributes
-from utils import RelationalSorter, convert, isk, slash_command_error_handler
+import parallel
+import prewarm
+from cache import cached
+from network import get_item_name, get_item_price, get_dogma_attributes, get_items_data
+from utils import RelationalSorter, convert, isk, pareto_frontier, slash_command_error_handler
 
 
 class Implant:
@@ -97,6 +100,9 @@ async def implant_from_id(type_id, set_bonus_id=None, set_malus_id=None, set_mul
 
 async def implants_from_ids(type_ids, set_bonus_id=None, set_malus_id=None, set_multiplier_id=None, bonus_ids=None,
                             malus_ids=None):
+    # Fill the static data cache for all implants at once
+    await get_items_data(type_ids)
+
     tasks = [
         implant_from_id(type_id, set_bonus_id, set_malus_id, set_multiplier_id, bonus_ids, malus_ids)
         for type_id in type_ids
@@ -105,28 +111,60 @@ async def implants_from_ids(type_ids, set_bonus_id=None, set_malus_id=None, set_
     return implants
 
 
-def combinations(implants):
-    """returns every possible combination of implants while
-    factoring in their slots, as well as the option to not have any implant in a slot"""
+def slot_options(implants):
+    """returns the implants fitting into every slot, as well as the option to not have any implant in a slot"""
     slot_dict = {x: [Implant(slot=x)] for x in range(1, 11)}  # Add in empty modules
     for implant in implants:
         slot_dict[implant.slot].append(implant)
+    return list(slot_dict.values())
+
 
-    for x in itertools.product(*slot_dict.values()):
+def combinations(implants):
+    """returns every possible combination of implants while
+    factoring in their slots, as well as the option to not have any implant in a slot"""
+    for x in itertools.product(*slot_options(implants)):
         yield ImplantSet(x)
 
 
+def shard_prefixes(options, shards):
+    """Splits all combinations by their implants in the first slots, into at least `shards` parts if possible"""
+    depth, count = 0, 1
+    while depth < len(options) and count < shards:
+        count *= len(options[depth])
+        depth += 1
+    return list(itertools.product(*(range(len(o)) for o in options[:depth])))
+
+
+def _shard_sets(prefix, options):
+    head = tuple(o[i] for o, i in zip(options, prefix))
+    for tail in itertools.product(*options[len(prefix):]):
+        yield ImplantSet(head + tail)
+
+
+def _shard_frontier(prefix, options):
+    return pareto_frontier((x.price, x.bonus) for x in _shard_sets(prefix, options))
+
+
+def _shard_best(prefix, options, sorter, min_price, max_price, results):
+    scored = ((sorter((x.price, x.bonus)), x) for x in _shard_sets(prefix, options) if min_price <= x.price <= max_price)
+    return heapq.nlargest(results, scored, key=lambda s: s[0])
+
+
 async def send_best(interaction: Interaction, min_price: str, max_price: str, implants):
     await interaction.response.defer()
 
     min_price = convert(min_price)
     max_price = convert(max_price)
 
-    sorter = RelationalSorter([(c.price, c.bonus) for c in combinations(implants)])
-    filtered_combinations = [x for x in combinations(implants) if min_price <= x.price <= max_price]
+    # Search shards of all combinations in worker processes, first for the sorter and then for the best sets
+    options = slot_options(implants)
+    prefixes = shard_prefixes(options, parallel.WORKERS * 4)
+    frontiers = await parallel.map_shards(_shard_frontier, prefixes, options)
+    sorter = RelationalSorter(pareto_frontier(itertools.chain.from_iterable(frontiers)))
 
-    best_sets = sorted(filtered_combinations, key=lambda x: sorter((x.price, x.bonus)), reverse=True)[:3]
-    ret = "\n".join([x.str_with_efficiency(sorter((x.price, x.bonus))) for x in best_sets])
+    shard_sets = await parallel.map_shards(_shard_best, prefixes, options, sorter, min_price, max_price, 3)
+    best_sets = heapq.nlargest(3, itertools.chain.from_iterable(shard_sets), key=lambda s: s[0])
+    ret = "\n".join([x.str_with_efficiency(efficiency) for efficiency, x in best_sets])
 
     if ret == "":
         await interaction.followup.send("No implant sets found for that price range!")
@@ -135,7 +173,7 @@ async def send_best(interaction: Interaction, min_price: str, max_price: str, im
     await interaction.followup.send(ret)
 
 
-@alru_cache(ttl=1800)
+@cached(maxsize=1, ttl=1800, stale_ttl=86400)
 async def _amulets():
     return await implants_from_ids(
         [
@@ -151,7 +189,7 @@ async def _amulets():
     )
 
 
-@alru_cache(ttl=1800)
+@cached(maxsize=1, ttl=1800, stale_ttl=86400)
 async def _ascendancies():
     return await implants_from_ids(
         [
@@ -165,7 +203,7 @@ async def _ascendancies():
     )
 
 
-@alru_cache(ttl=1800)
+@cached(maxsize=1, ttl=1800, stale_ttl=86400)
 async def _asklepians():
     return await implants_from_ids(
         [
@@ -184,7 +222,7 @@ async def _asklepians():
     )
 
 
-@alru_cache(ttl=1800)
+@cached(maxsize=1, ttl=1800, stale_ttl=86400)
 async def _crystals():
     return await implants_from_ids(
         [
@@ -197,7 +235,7 @@ async def _crystals():
     )
 
 
-@alru_cache(ttl=1800)
+@cached(maxsize=1, ttl=1800, stale_ttl=86400)
 async def _snakes():
     return await implants_from_ids(
         [
@@ -213,7 +251,7 @@ async def _snakes():
     )
 
 
-@alru_cache(ttl=1800)
+@cached(maxsize=1, ttl=1800, stale_ttl=86400)
 async def _talismans():
     return await implants_from_ids(
         [
@@ -226,7 +264,7 @@ async def _talismans():
     )
 
 
-@alru_cache(ttl=1800)
+@cached(maxsize=1, ttl=1800, stale_ttl=86400)
 async def _halos():
     return await implants_from_ids(
         [
@@ -239,7 +277,7 @@ async def _halos():
     )
 
 
-@alru_cache(ttl=1800)
+@cached(maxsize=1, ttl=1800, stale_ttl=86400)
 async def _hydras():
     return await implants_from_ids(
         [
@@ -252,7 +290,7 @@ async def _hydras():
     )
 
 
-@alru_cache(ttl=1800)
+@cached(maxsize=1, ttl=1800, stale_ttl=86400)
 async def _mimesiss():
     return await implants_from_ids(
         [
@@ -265,7 +303,7 @@ async def _mimesiss():
     )
 
 
-@alru_cache(ttl=1800)
+@cached(maxsize=1, ttl=1800, stale_ttl=86400)
 async def _raptures():
     return await implants_from_ids(
         [
@@ -282,7 +320,7 @@ async def _raptures():
     )
 
 
-@alru_cache(ttl=1800)
+@cached(maxsize=1, ttl=1800, stale_ttl=86400)
 async def _saviors():
     return await implants_from_ids(
         [
@@ -295,7 +333,7 @@ async def _saviors():
     )
 
 
-@alru_cache(ttl=1800)
+@cached(maxsize=1, ttl=1800, stale_ttl=86400)
 async def _harvests():
     return await implants_from_ids(
         [
@@ -307,7 +345,7 @@ async def _harvests():
     )
 
 
-@alru_cache(ttl=1800)
+@cached(maxsize=1, ttl=1800, stale_ttl=86400)
 async def _nirvanas():
     return await implants_from_ids(
         [
@@ -322,7 +360,7 @@ async def _nirvanas():
     )
 
 
-@alru_cache(ttl=1800)
+@cached(maxsize=1, ttl=1800, stale_ttl=86400)
 async def _nomads():
     return await implants_from_ids(
         [
@@ -336,7 +374,7 @@ async def _nomads():
     )
 
 
-@alru_cache(ttl=1800)
+@cached(maxsize=1, ttl=1800, stale_ttl=86400)
 async def _virtues():
     return await implants_from_ids(
         [
@@ -350,6 +388,13 @@ async def _virtues():
     )
 
 
+# Every implant family, kept warm by the prewarm task
+implant_families = (
+    _amulets, _ascendancies, _asklepians, _crystals, _snakes, _talismans, _halos, _hydras,
+    _mimesiss, _raptures, _saviors, _harvests, _nirvanas, _nomads, _virtues,
+)
+
+
 class ImplantCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
@@ -535,5 +580,10 @@ class ImplantCog(commands.Cog):
         await send_best(interaction, min_price, max_price, await _virtues())
 
 
+async def _warm_family(family):
+    await family.refresh()
+
+
 async def setup(bot):
+    prewarm.register("implants", 1500, implant_families, _warm_family)
     await bot.add_cog(ImplantCog(bot))
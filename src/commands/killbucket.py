@@ -5,7 +5,7 @@ import discord
 import matplotlib.pyplot as plt
 from discord.ext import commands
 
-from network import fetch_kill_until, id_lookup
+from network import fetch_kill_until, id_lookup, killmail_store
 from utils import unix_style_arg_parser, command_error_handler
 
 
@@ -159,8 +159,29 @@ def judgment_phrase_generator(name, id, kills, days, group):
             return group_smallgang_generator(name)
 
 
+def bucket_name(pilots):
+    if pilots == 1:
+        return "solo"
+    elif pilots < 5:
+        return "five"
+    elif pilots < 10:
+        return "ten"
+    elif pilots < 15:
+        return "fifteen"
+    elif pilots < 20:
+        return "twenty"
+    elif pilots < 30:
+        return "thirty"
+    elif pilots < 40:
+        return "forty"
+    elif pilots < 50:
+        return "fifty"
+    else:
+        return "blob"
+
+
 # Function to get all kills from a zkb link
-async def gather_buckets(zkill_url, end_date, aggregate):
+async def gather_buckets(zkill_url, end_date, aggregate, entity_id):
     buckets = {
         "solo": 0,
         "five": 0,
@@ -173,29 +194,24 @@ async def gather_buckets(zkill_url, end_date, aggregate):
         "blob": 0,
     }
 
-    async for kill in fetch_kill_until(zkill_url, start=end_date):
+    # Days stored completely in the local killmail store are scanned there, only newer kills are fetched
+    fetch_from = end_date
+    if killmail_store is not None:
+        fetch_from = await killmail_store.run(killmail_store.complete_until, end_date)
+
+        def count_local(local_end):
+            for partition, index, friendly_rows in killmail_store.kills(entity_id, end_date, local_end):
+                pilots = len(partition.attackers(index))
+                buckets[bucket_name(pilots)] += 1 if aggregate is None else max(1, len(friendly_rows))
+
+        await killmail_store.run(count_local, fetch_from - datetime.timedelta(seconds=1))
+
+    async for kill in fetch_kill_until(zkill_url, start=fetch_from):
         pilots = len(kill["attackers"])
         friendlies = max(1, len([a for a in kill["attackers"] if
                                  "corporation_id" in a and a["corporation_id"] == aggregate or "alliance_id" in a and a[
                                      "alliance_id"] == aggregate]))
-        if pilots == 1:
-            buckets["solo"] += friendlies
-        elif pilots < 5:
-            buckets["five"] += friendlies
-        elif pilots < 10:
-            buckets["ten"] += friendlies
-        elif pilots < 15:
-            buckets["fifteen"] += friendlies
-        elif pilots < 20:
-            buckets["twenty"] += friendlies
-        elif pilots < 30:
-            buckets["thirty"] += friendlies
-        elif pilots < 40:
-            buckets["forty"] += friendlies
-        elif pilots < 50:
-            buckets["fifty"] += friendlies
-        elif pilots >= 50:
-            buckets["blob"] += friendlies
+        buckets[bucket_name(pilots)] += friendlies
 
     return buckets
 
@@ -276,7 +292,8 @@ async def killbucket(ctx, *args):
     kill_buckets = await gather_buckets(
         f"https://zkillboard.com/api/kills/{querry}/{id}/kills/",
         until,
-        aggregate=aggregate
+        aggregate=aggregate,
+        entity_id=id
     )
 
     await make_plot(
@@ -297,7 +314,7 @@ async def linkkb(ctx, *args):
     !linkkb <character_name>|<character_id>
     """
     try:
-        await ctx.send(f"https://zkillboard.com/character/{id_lookup(' '.join(*args), 'characters')}/")
+        await ctx.send(f"https://zkillboard.com/character/{await id_lookup(' '.join(args), 'characters')}/")
     except ValueError:
         await ctx.send('I\'m not sure who that is')
 
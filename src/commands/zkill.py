@@ -98,7 +98,8 @@ async def explain(ctx, zkill_link):
             )
 
     # Fetch all required information for items
-    await asyncio.gather(*[i.fetch for i in items])
+    await get_items_data([i.type_id for i in items])
+    await asyncio.gather(*[i.fetch() for i in items])
 
     # Parse item information
     danger = 0
@@ -160,7 +161,8 @@ async def explain(ctx, zkill_link):
         return
 
     # Fetch all required information for the attackers
-    attacker_task =  asyncio.gather(*[i.fetch for i in attacker_ships])
+    await get_items_data([i.type_id for i in attacker_ships] + maybe_structure)
+    attacker_task = asyncio.gather(*[i.fetch() for i in attacker_ships])
     structure_task = asyncio.gather(*[is_structure(t) for t in maybe_structure])
     _, structure_results = await asyncio.gather(attacker_task, structure_task)
 
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import logging
+from typing import NamedTuple
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ContractDiff(NamedTuple):
+    """Objects that were added or removed, and (old, new) pairs of objects whose contract changed, e.g. a new price."""
+    added: list
+    removed: list
+    changed: list
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+
+def _fingerprint(item):
+    return json.dumps(item.get("contract"), sort_keys=True)
+
+
+class ContractIndex:
+    """Contracts of one mutamarket type, keyed by module id.
+
+    Each entry keeps the object built from the contract, or None if the contract is not a usable offer,
+    so unchanged contracts are never parsed again.
+    """
+
+    def __init__(self):
+        self.entries = {}  # module_id -> (fingerprint, object)
+
+    def changes(self, items):
+        """Returns the fetched items that are new or changed, and the ids of the modules that are gone."""
+        seen = set()
+        pending = []
+        for item in items:
+            seen.add(module_id := item.get("id"))
+            if (entry := self.entries.get(module_id)) is None or entry[0] != _fingerprint(item):
+                pending.append(item)
+
+        return pending, [module_id for module_id in self.entries if module_id not in seen]
+
+    def apply(self, pending, built, removed) -> ContractDiff:
+        """Stores the objects `built` for the `pending` items and drops the `removed` modules."""
+        diff = ContractDiff([], [], [])
+        for module_id in removed:
+            if (old := self.entries.pop(module_id)[1]) is not None:
+                diff.removed.append(old)
+
+        for item, new in zip(pending, built):
+            old = self.entries.get(module_id := item.get("id"), (None, None))[1]
+            self.entries[module_id] = (_fingerprint(item), new)
+
+            if new is None:
+                if old is not None:
+                    diff.removed.append(old)
+            elif old is None:
+                diff.added.append(new)
+            else:
+                diff.changed.append((old, new))
+
+        return diff
+
+    def values(self) -> list:
+        return [obj for _, obj in self.entries.values() if obj is not None]
+
+
+class ContractSync:
+    """Keeps a ContractIndex per type in sync with mutamarket, only building objects for changed contracts.
+
+    Parameters
+    ----------
+    name : str
+        Name used in logs and metrics.
+    fetch : async callable
+        Takes a type id and returns the full contract list of that type.
+    build : async callable
+        Takes a type id, a list of new or changed contract items and any extra arguments passed to sync,
+        returns one object per item, or None for items that are no usable offer.
+    """
+
+    def __init__(self, name, fetch, build):
+        self.name = name
+        self.fetch = fetch
+        self.build = build
+        self.indexes = {}
+        self.locks = {}
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        """Calls `callback(type_id, diff)` after every sync that changed something."""
+        self.subscribers.append(callback)
+
+    async def sync(self, type_id, *args) -> list:
+        """Fetches the contracts of `type_id`, applies the changes and returns all current objects."""
+        async with self.locks.setdefault(type_id, asyncio.Lock()):
+            items = await self.fetch(type_id)
+            index = self.indexes.setdefault(type_id, ContractIndex())
+
+            pending, removed = index.changes(items)
+            built = await self.build(type_id, pending, *args) if pending else []
+            diff = index.apply(pending, built, removed)
+
+            for change in ContractDiff._fields:
+                metrics.inc("contract_changes_total", len(getattr(diff, change)), sync=self.name, change=change)
+
+            if diff:
+                for callback in self.subscribers:
+                    try:
+                        callback(type_id, diff)
+                    except Exception as e:
+                        logger.error(f"Subscriber of {self.name} failed: {e}", exc_info=True)
+
+            return index.values()
@@ -0,0 +1,209 @@
+"""Recorded HTTP responses and a local stand-in server replaying them.
+
+Record while using the bot normally by setting HTTP_RECORD_PATH, then replay offline with
+
+    python fixtures.py fixtures/ --port 8089 --latency 0.05 --error-rate 0.01 --rate zkillboard.com=1
+
+and HTTP_UPSTREAM="http://127.0.0.1:8089", which sends every request to the stand-in server instead.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from aiohttp import web
+from yarl import URL
+
+# Everything else, like Content-Encoding or Set-Cookie, does not matter for replaying
+KEPT_HEADERS = (
+    "Content-Type", "Date", "Expires", "ETag", "Last-Modified", "Retry-After", "X-Pages",
+    "X-Esi-Error-Limit-Remain", "X-Esi-Error-Limit-Reset",
+)
+
+
+def fixture_key(method, url, body=None):
+    """Identifies a request by method, host, path, query and json body."""
+    url = URL(url)
+    key = f"{method} {url.host}{url.raw_path_qs}"
+    if body is not None:
+        key += " " + json.dumps(body, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def redirect(url, upstream):
+    """Rewrites `url` to point at the stand-in server, keeping the original host as first path segment."""
+    url = URL(url)
+    return f"{upstream.rstrip('/')}/{url.host}{url.raw_path_qs}"
+
+
+class FixtureStore:
+    """Directory of recorded responses, one json file per request.
+
+    Parameters
+    ----------
+    root : str
+        Directory holding one subdirectory per host.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, host, key):
+        return os.path.join(self.root, host, f"{key}.json")
+
+    def record(self, method, url, body, status, headers, content: bytes):
+        try:
+            text, encoded = content.decode(), None
+        except UnicodeDecodeError:
+            text, encoded = None, base64.b64encode(content).decode()
+
+        fixture = {
+            "method": method,
+            "url": url,
+            "request": body,
+            "status": status,
+            "headers": {name: headers[name] for name in KEPT_HEADERS if name in headers},
+            "body": text,
+            "body_base64": encoded,
+        }
+
+        path = self._path(URL(url).host, fixture_key(method, url, body))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(fixture, f, indent=1)
+        os.replace(path + ".tmp", path)
+
+    def load(self, method, url, body=None):
+        """Returns the recorded fixture for a request, or None if it was never recorded."""
+        path = self._path(URL(url).host, fixture_key(method, url, body))
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+
+class FakeUpstream:
+    """aiohttp application replaying a FixtureStore with simulated latency, errors and rate limits.
+
+    Parameters
+    ----------
+    store : FixtureStore
+        The recorded responses.
+    latency : float
+        Mean delay in seconds before answering.
+    jitter : float
+        Maximum deviation from `latency`, uniformly distributed.
+    error_rate : float
+        Share of requests answered with a 502 / 503 instead of the fixture.
+    rates : dict
+        Requests per second allowed per host, faster requests get a 429 (or a 420 from ESI).
+    seed : int
+        Seed for the random numbers, so a run can be repeated exactly.
+    """
+
+    def __init__(self, store, latency=0.0, jitter=0.0, error_rate=0.0, rates=None, seed=None):
+        self.store = store
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rates = rates or {}
+        self.random = random.Random(seed)
+        self.tokens = {host: (1.0, time.monotonic()) for host in self.rates}
+
+        # The ESI error limit: 100 errors per 60 second window
+        self.esi_errors = 100
+        self.esi_reset_at = time.monotonic() + 60
+
+    def application(self):
+        app = web.Application()
+        app.router.add_route("*", "/{host}/{path:.*}", self.handle)
+        return app
+
+    def _allowed(self, host):
+        if host not in self.rates:
+            return True
+        tokens, last = self.tokens[host]
+        now = time.monotonic()
+        tokens = min(1.0, tokens + (now - last) * self.rates[host])
+        allowed = tokens >= 1
+        self.tokens[host] = (tokens - 1 if allowed else tokens, now)
+        return allowed
+
+    def _esi_headers(self, status):
+        now = time.monotonic()
+        if now >= self.esi_reset_at:
+            self.esi_errors, self.esi_reset_at = 100, now + 60
+        if status >= 400:
+            self.esi_errors = max(0, self.esi_errors - 1)
+        return {
+            "X-Esi-Error-Limit-Remain": str(self.esi_errors),
+            "X-Esi-Error-Limit-Reset": str(max(0, round(self.esi_reset_at - now))),
+        }
+
+    def _respond(self, host, status, headers=None, **kwargs):
+        headers = dict(headers or {})
+        if host == "esi.evetech.net":
+            headers.update(self._esi_headers(status))
+        return web.Response(status=status, headers=headers, **kwargs)
+
+    @staticmethod
+    def _shift_expiry(headers):
+        """Moves Expires as far into the future as it was when recorded, so the response cache behaves the same."""
+        try:
+            lifetime = parsedate_to_datetime(headers["Expires"]) - parsedate_to_datetime(headers["Date"])
+        except (KeyError, TypeError, ValueError):
+            return headers
+        now = datetime.now(timezone.utc)
+        return {**headers, "Date": format_datetime(now, usegmt=True), "Expires": format_datetime(now + lifetime, usegmt=True)}
+
+    async def handle(self, request):
+        host = request.match_info["host"]
+        await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+
+        if host == "esi.evetech.net" and self.esi_errors == 0 and time.monotonic() < self.esi_reset_at:
+            return self._respond(host, 420, text="Error limited")
+        if not self._allowed(host):
+            status = 420 if host == "esi.evetech.net" else 429
+            return self._respond(host, status, {"Retry-After": "1"}, text="Rate limited")
+        if self.random.random() < self.error_rate:
+            return self._respond(host, self.random.choice((502, 503)), text="Simulated error")
+
+        body = await request.json() if request.can_read_body else None
+        url = f"https://{host}{request.raw_path[len(host) + 1:]}"
+        if (fixture := self.store.load(request.method, url, body)) is None:
+            return self._respond(host, 404, text=json.dumps({"error": f"No fixture for {request.method} {url}"}))
+
+        headers = dict(self._shift_expiry(fixture["headers"]))
+        content_type = headers.pop("Content-Type", "application/json").split(";")[0]
+        if (etag := headers.get("ETag")) and request.headers.get("If-None-Match") == etag:
+            return self._respond(host, 304, headers)
+
+        if fixture["body_base64"] is not None:
+            content = base64.b64decode(fixture["body_base64"])
+        else:
+            content = fixture["body"].encode()
+        return self._respond(host, fixture["status"], headers, body=content, content_type=content_type)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded responses as a local stand-in for the real APIs.")
+    parser.add_argument("fixtures", help="directory written with HTTP_RECORD_PATH")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.0, help="mean response delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="maximum deviation from the mean delay")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests failing with a 5xx")
+    parser.add_argument("--rate", action="append", default=[], metavar="HOST=RPS", help="rate limit of one host")
+    parser.add_argument("--seed", type=int, default=None)
+    arguments = parser.parse_args()
+
+    rates = {host: float(rps) for host, rps in (rate.split("=") for rate in arguments.rate)}
+    upstream = FakeUpstream(
+        FixtureStore(arguments.fixtures), arguments.latency, arguments.jitter, arguments.error_rate, rates, arguments.seed
+    )
+    web.run_app(upstream.application(), host="127.0.0.1", port=arguments.port)
@@ -0,0 +1,195 @@
+import asyncio
+import concurrent.futures
+import json
+import logging
+import sqlite3
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Preset dictionary for zlib, single killmails are too small to compress well without one
+ZDICT = (
+    b'{"attackers":[{"alliance_id":,"character_id":,"corporation_id":,"damage_done":,"final_blow":false,'
+    b'"security_status":,"ship_type_id":,"weapon_type_id":},"final_blow":true,"killmail_id":,"killmail_time":"'
+    b'T:Z","solar_system_id":,"victim":{"items":[{"flag":,"item_type_id":,"quantity_destroyed":1,'
+    b'"quantity_dropped":1,"singleton":0}],"position":{"x":,"y":,"z":},"damage_taken":,"war_id":'
+)
+ENCODING_VERSION = 1
+
+
+def encode(kill) -> bytes:
+    compressor = zlib.compressobj(level=9, zdict=ZDICT)
+    data = json.dumps(kill, separators=(",", ":")).encode()
+    return bytes([ENCODING_VERSION]) + compressor.compress(data) + compressor.flush()
+
+
+def decode(blob) -> dict:
+    if blob[0] != ENCODING_VERSION:
+        raise ValueError(f"Unknown killmail encoding {blob[0]}")
+    decompressor = zlib.decompressobj(zdict=ZDICT)
+    return json.loads(decompressor.decompress(blob[1:]) + decompressor.flush())
+
+
+class KillmailCache:
+    """Persistent cache of ESI killmails keyed by (kill_id, hash).
+
+    The hash is derived from the killmail content, so an entry can never go stale and is only
+    dropped to stay below `max_bytes`, least recently used first.
+
+    All sqlite work runs on one thread of its own, so the event loop never waits for the disk. New killmails
+    are queued and written in one transaction per batch, e.g. all kills of a zkillboard page at once.
+
+    Parameters
+    ----------
+    path : str
+        Location of the sqlite database, created on first use.
+    max_bytes : int
+        Upper bound for the total size of the stored (compressed) killmails.
+    batch_size : int
+        Queued killmails are written right away once there are this many.
+    flush_delay : float
+        Seconds a killmail waits for others to be written with.
+    """
+
+    def __init__(self, path, max_bytes=512 * 1024 * 1024, batch_size=200, flush_delay=1.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.flush_delay = flush_delay
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+        # Access times are written in batches instead of once per hit
+        self._touched = {}
+        # Killmails waiting to be written, and the batches being written right now
+        self._pending = {}
+        self._writing = []
+        self._timer = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="killmail-cache")
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            with self._connection:
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS killmails ("
+                    "kill_id INTEGER NOT NULL, hash TEXT NOT NULL, data BLOB NOT NULL, "
+                    "size INTEGER NOT NULL, last_access INTEGER NOT NULL, PRIMARY KEY (kill_id, hash))"
+                )
+                self._connection.execute(
+                    "CREATE INDEX IF NOT EXISTS killmails_last_access ON killmails (last_access)"
+                )
+            self.size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM killmails").fetchone()[0]
+        return self._connection
+
+    async def get(self, kill_id, kill_hash):
+        """Returns the stored killmail, or None if it is not cached."""
+        for batch in (self._pending, *self._writing):
+            if (kill := batch.get((kill_id, kill_hash))) is not None:
+                self.hits += 1
+                return kill
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._read, kill_id, kill_hash)
+
+    def put(self, kill_id, kill_hash, kill):
+        """Queues a killmail to be written together with the others arriving within `flush_delay`."""
+        self._pending[(kill_id, kill_hash)] = kill
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_delay, self._flush)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        self._writing.append(batch)
+        future = asyncio.get_running_loop().run_in_executor(self._executor, self._write, batch)
+        future.add_done_callback(lambda f: self._written(batch, f))
+
+    def _written(self, batch, future):
+        self._writing.remove(batch)
+        if not future.cancelled() and (error := future.exception()) is not None:
+            logger.warning(f"Could not store {len(batch)} killmails: {error}")
+
+    def _read(self, kill_id, kill_hash):
+        row = self.connection.execute(
+            "SELECT data FROM killmails WHERE kill_id = ? AND hash = ?", (kill_id, kill_hash)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._touched[(kill_id, kill_hash)] = int(time.time())
+        if len(self._touched) >= 1000:
+            self._flush_touched()
+        return decode(row[0])
+
+    def _write(self, batch):
+        rows = [(kill_id, kill_hash, encode(kill)) for (kill_id, kill_hash), kill in batch.items()]
+        now = int(time.time())
+        with self.connection:
+            for kill_id, kill_hash, blob in rows:
+                old = self.connection.execute(
+                    "SELECT size FROM killmails WHERE kill_id = ? AND hash = ?", (kill_id, kill_hash)
+                ).fetchone()
+                self.size += len(blob) - (old[0] if old else 0)
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO killmails (kill_id, hash, data, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                [(kill_id, kill_hash, blob, len(blob), now) for kill_id, kill_hash, blob in rows]
+            )
+
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Drops the least recently used killmails until the cache is at 90% of `max_bytes`."""
+        self._flush_touched()
+        target = self.max_bytes * 0.9
+
+        with self.connection:
+            rows = self.connection.execute("SELECT rowid, size FROM killmails ORDER BY last_access")
+            dropped = []
+            for rowid, size in rows:
+                if self.size <= target:
+                    break
+                dropped.append((rowid,))
+                self.size -= size
+            self.connection.executemany("DELETE FROM killmails WHERE rowid = ?", dropped)
+
+    def _flush_touched(self):
+        if not self._touched:
+            return
+        touched, self._touched = self._touched, {}
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE killmails SET last_access = ? WHERE kill_id = ? AND hash = ?",
+                [(last_access, kill_id, kill_hash) for (kill_id, kill_hash), last_access in touched.items()]
+            )
+
+    def _close(self):
+        if self._connection is not None:
+            self._flush_touched()
+            self._connection.close()
+            self._connection = None
+
+    def close(self):
+        """Writes everything still queued and closes the database, waiting for the thread to finish."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._pending:
+            batch, self._pending = self._pending, {}
+            self._executor.submit(self._write, batch)
+        self._executor.submit(self._close)
+        self._executor.shutdown(wait=True)
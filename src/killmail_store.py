@@ -0,0 +1,303 @@
+"""Local killmail store holding compact column arrays, partitioned by day.
+
+Fill it with full days from everef, e.g. for all of January 2024:
+
+    python killmail_store.py killmails/ 20240101 20240131
+"""
+import argparse
+import asyncio
+import calendar
+import concurrent.futures
+import json
+import os
+import time
+from array import array
+from datetime import datetime, timedelta, timezone
+
+from cache import LRUCache
+
+KILL_COLUMNS = {
+    "kill_ids": "I",
+    "times": "q",  # Unix epoch seconds
+    "victim_ships": "I",
+    "victim_characters": "I",
+    "victim_corporations": "I",
+    "victim_alliances": "I",
+    "attacker_starts": "I",  # Attackers of kill i are rows attacker_starts[i]:attacker_starts[i + 1]
+}
+
+ATTACKER_COLUMNS = {
+    "attacker_characters": "I",
+    "attacker_corporations": "I",
+    "attacker_alliances": "I",
+}
+
+
+def epoch(some_time) -> int:
+    """Converts a killmail timestamp or datetime into unix epoch seconds, naive datetimes are taken as UTC."""
+    if isinstance(some_time, str):
+        return calendar.timegm(time.strptime(some_time, '%Y-%m-%dT%H:%M:%SZ'))
+    if some_time.tzinfo is None:
+        some_time = some_time.replace(tzinfo=timezone.utc)
+    return int(some_time.timestamp())
+
+
+def day_of(epoch_seconds) -> str:
+    return time.strftime("%Y%m%d", time.gmtime(epoch_seconds))
+
+
+class DayPartition:
+    """All stored killmails of one day, as one array per column."""
+
+    def __init__(self, complete=False):
+        self.complete = complete
+        for name, typecode in (KILL_COLUMNS | ATTACKER_COLUMNS).items():
+            setattr(self, name, array(typecode))
+        self.attacker_starts.append(0)
+
+    def __len__(self):
+        return len(self.kill_ids)
+
+    @property
+    def attacker_counts(self):
+        return [end - start for start, end in zip(self.attacker_starts, self.attacker_starts[1:])]
+
+    def attackers(self, index) -> range:
+        """Returns the rows of the attacker columns belonging to kill `index`."""
+        return range(self.attacker_starts[index], self.attacker_starts[index + 1])
+
+    def append(self, kill):
+        victim = kill.get("victim", {})
+        self.kill_ids.append(kill["killmail_id"])
+        self.times.append(epoch(kill["killmail_time"]))
+        self.victim_ships.append(victim.get("ship_type_id", 0))
+        self.victim_characters.append(victim.get("character_id", 0))
+        self.victim_corporations.append(victim.get("corporation_id", 0))
+        self.victim_alliances.append(victim.get("alliance_id", 0))
+
+        for attacker in kill.get("attackers", []):
+            self.attacker_characters.append(attacker.get("character_id", 0))
+            self.attacker_corporations.append(attacker.get("corporation_id", 0))
+            self.attacker_alliances.append(attacker.get("alliance_id", 0))
+        self.attacker_starts.append(len(self.attacker_characters))
+
+    def as_dict(self, index):
+        """Rebuilds the stored fields of kill `index` in the ESI killmail layout."""
+
+        def entity(character_id, corporation_id, alliance_id):
+            ids = {"character_id": character_id, "corporation_id": corporation_id, "alliance_id": alliance_id}
+            return {k: v for k, v in ids.items() if v}
+
+        return {
+            "killmail_id": self.kill_ids[index],
+            "killmail_time": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.times[index])),
+            "victim": {
+                "ship_type_id": self.victim_ships[index],
+                **entity(self.victim_characters[index], self.victim_corporations[index], self.victim_alliances[index]),
+            },
+            "attackers": [
+                entity(self.attacker_characters[row], self.attacker_corporations[row], self.attacker_alliances[row])
+                for row in self.attackers(index)
+            ],
+        }
+
+    def save(self, path):
+        columns = KILL_COLUMNS | ATTACKER_COLUMNS
+        header = {
+            "version": 1,
+            "complete": self.complete,
+            "columns": [[name, typecode, len(getattr(self, name))] for name, typecode in columns.items()],
+        }
+        with open(path + ".tmp", "wb") as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            for name in columns:
+                getattr(self, name).tofile(f)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+            partition = cls(header["complete"])
+            for name, typecode, length in header["columns"]:
+                column = array(typecode)
+                column.fromfile(f, length)
+                setattr(partition, name, column)
+        return partition
+
+
+class KillmailStore:
+    """On-disk killmail store with one file per day, so analytics can scan local columns instead of the APIs.
+
+    Parameters
+    ----------
+    root : str
+        Directory holding the day files.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.partitions = LRUCache(maxsize=64)
+        # Partitions are only read and changed on this thread, so the bot's event loop never waits for them
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="killmail-store")
+
+    async def run(self, func, *args):
+        """Runs `func(*args)` on the store's thread, use it for everything touching the partitions."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def add_later(self, kills):
+        """Stores `kills` on the store's thread without waiting for it."""
+        self.executor.submit(self.add, kills)
+
+    def _path(self, day):
+        return os.path.join(self.root, day[:4], f"{day}.kms")
+
+    def _mtime(self, day):
+        try:
+            return os.stat(self._path(day)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def partition(self, day):
+        """Returns the partition of `day` (YYYYMMDD), or None if nothing is stored for it.
+
+        Day files replaced by another process, e.g. an ingest run while the bot is up, are read again.
+        """
+        mtime = self._mtime(day)
+        if (cached := self.partitions.get(day)) is not None and cached[0] == mtime:
+            return cached[1]
+        if mtime is None:
+            return None
+        partition = DayPartition.load(self._path(day))
+        self.partitions.set(day, (mtime, partition))
+        return partition
+
+    def _save(self, day, partition):
+        os.makedirs(os.path.dirname(self._path(day)), exist_ok=True)
+        partition.save(self._path(day))
+        self.partitions.set(day, (self._mtime(day), partition))
+
+    def add(self, kills):
+        """Stores `kills` (ESI killmails), appending them to their day partitions."""
+        by_day = {}
+        for kill in kills:
+            if "killmail_time" in kill:
+                by_day.setdefault(day_of(epoch(kill["killmail_time"])), []).append(kill)
+
+        for day, day_kills in by_day.items():
+            partition = self.partition(day) or DayPartition()
+
+            # Killmails never change, so there is nothing to do for ones that are already stored
+            known = set(partition.kill_ids)
+            new_kills = {kill["killmail_id"]: kill for kill in day_kills if kill["killmail_id"] not in known}
+            for kill in new_kills.values():
+                partition.append(kill)
+            if new_kills:
+                self._save(day, partition)
+
+    def close(self):
+        """Waits for the kills still being stored."""
+        self.executor.shutdown(wait=True)
+
+    def replace(self, day, partition):
+        """Replaces everything stored for `day`, used once a full day has been ingested."""
+        self._save(day, partition)
+
+    @staticmethod
+    def days(start, end):
+        """Returns all days (YYYYMMDD) between the datetimes `start` and `end`, both included."""
+        first = datetime.strptime(day_of(epoch(start)), "%Y%m%d")
+        last = datetime.strptime(day_of(epoch(end)), "%Y%m%d")
+        return [(first + timedelta(days=d)).strftime("%Y%m%d") for d in range((last - first).days + 1)]
+
+    def covers(self, start, end):
+        """Checks whether every day between `start` and `end` has been stored completely."""
+        for day in self.days(start, end):
+            if (partition := self.partition(day)) is None or not partition.complete:
+                return False
+        return True
+
+    def complete_until(self, start):
+        """Returns the end of the run of completely stored days beginning at `start`, or `start` if there is none.
+
+        Everything between `start` and the returned datetime can be read locally, only newer kills need fetching.
+        """
+        day = datetime.strptime(day_of(epoch(start)), "%Y%m%d")
+        today = datetime.strptime(day_of(time.time()), "%Y%m%d")
+        while day <= today and (partition := self.partition(day.strftime("%Y%m%d"))) is not None and partition.complete:
+            day += timedelta(days=1)
+
+        if day.strftime("%Y%m%d") == day_of(epoch(start)):
+            return start
+        return day if start.tzinfo is None else day.replace(tzinfo=timezone.utc)
+
+    def scan(self, start, end):
+        """Yields (partition, index) for every stored kill between `start` and `end`, in no particular order."""
+        days = self.days(start, end)
+        start, end = epoch(start), epoch(end)
+        for day in days:
+            if (partition := self.partition(day)) is None:
+                continue
+            if days[0] < day < days[-1]:
+                # Days between the first and the last one are covered completely
+                for index in range(len(partition)):
+                    yield partition, index
+                continue
+            for index, kill_time in enumerate(partition.times):
+                if start <= kill_time <= end:
+                    yield partition, index
+
+    def kills(self, entity_id, start, end):
+        """Yields (partition, index, friendly attacker rows) for every kill with `entity_id` among the attackers.
+
+        The entity can be a character, corporation or alliance id, those never overlap.
+        """
+        for partition, index in self.scan(start, end):
+            friendlies = [
+                row for row in partition.attackers(index)
+                if entity_id in (partition.attacker_characters[row],
+                                 partition.attacker_corporations[row],
+                                 partition.attacker_alliances[row])
+            ]
+            if friendlies:
+                yield partition, index, friendlies
+
+    def losses(self, entity_id, start, end):
+        """Yields (partition, index) for every kill with `entity_id` as victim."""
+        for partition, index in self.scan(start, end):
+            if entity_id in (partition.victim_characters[index],
+                             partition.victim_corporations[index],
+                             partition.victim_alliances[index]):
+                yield partition, index
+
+
+async def ingest_everef_days(store, days):
+    """Stores the full everef archive of each day in `days` (YYYYMMDD) and marks them complete."""
+    from network import get_everef_kills
+
+    for day in days:
+        # Append straight into the columns, so a full day never sits in memory as dictionaries
+        partition = DayPartition(complete=True)
+        other_days = []
+        async for kill in get_everef_kills(day):
+            if "killmail_time" not in kill:
+                continue
+            if day_of(epoch(kill["killmail_time"])) == day:
+                partition.append(kill)
+            else:
+                other_days.append(kill)
+
+        store.replace(day, partition)
+        store.add(other_days)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest everef killmail archives into a local killmail store.")
+    parser.add_argument("root", help="directory of the killmail store")
+    parser.add_argument("first_day", help="first day to ingest (YYYYMMDD)")
+    parser.add_argument("last_day", help="last day to ingest (YYYYMMDD)")
+    arguments = parser.parse_args()
+
+    first_day = datetime.strptime(arguments.first_day, "%Y%m%d")
+    last_day = datetime.strptime(arguments.last_day, "%Y%m%d")
+    asyncio.run(ingest_everef_days(KillmailStore(arguments.root), KillmailStore.days(first_day, last_day)))
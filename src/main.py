@@ -5,18 +5,37 @@ import os
 import discord
 from discord.ext import commands
 
+import network
+import parallel
+import prewarm
+
 intent = discord.Intents.default()
 intent.messages = True
 intent.message_content = True
 client = discord.Client(intents=intent)
 
-bot = commands.Bot(command_prefix='!', intents=intent)
+
+class Bot(commands.Bot):
+    async def setup_hook(self):
+        await network.open_session()
+        self.prewarm_tasks = prewarm.start()
+
+    async def close(self):
+        for task in getattr(self, "prewarm_tasks", []):
+            task.cancel()
+        await super().close()
+        await network.close_session()
+        parallel.shutdown()
+
+
+bot = Bot(command_prefix='!', intents=intent)
 
 # Configure the logger
 logger = logging.getLogger('discord.main')
 logger.setLevel(logging.INFO)
 
 extensions = [
+    "commands.admin",
     "commands.abyssal_damage_mods",
     "commands.implants",
     # "commands.killbucket",
@@ -28,10 +47,6 @@ extensions = [
     # "commands.zkill",
 ]
 
-for extension in extensions:
-    asyncio.run(bot.load_extension(extension))
-
-
 @bot.event
 async def on_ready():
     await bot.wait_until_ready()
@@ -42,4 +57,9 @@ async def on_ready():
         logger.info(f"Failed to sync commands: {e}")
 
 
-bot.run(os.environ["DISCORD_TOKEN"])
+# Optimizer worker processes import this module as well, they must not start another bot
+if __name__ == "__main__":
+    for extension in extensions:
+        asyncio.run(bot.load_extension(extension))
+
+    bot.run(os.environ["DISCORD_TOKEN"])
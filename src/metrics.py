@@ -0,0 +1,186 @@
+"""In-process metrics, rendered in the Prometheus text format.
+
+Set METRICS_PATH to have the metrics written to a file, e.g. for the node exporter textfile collector.
+"""
+import os
+import re
+from bisect import bisect_left
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket holding the `q` quantile."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format(name, labels, suffix="", extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return f"{name}{suffix}"
+    rendered = ",".join(f'{k}="{str(v).replace(chr(34), chr(39))}"' for k, v in pairs)
+    return f"{name}{suffix}{{{rendered}}}"
+
+
+def _number(value):
+    return "+Inf" if value == float("inf") else f"{value:g}"
+
+
+class Metrics:
+    """Registry of counters, histograms and gauges, each keyed by name and labels."""
+
+    def __init__(self):
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.gauges = {}
+        self.caches = {}
+        self.cache_counts = defaultdict(lambda: [0, 0])
+
+    def inc(self, name, value=1, **labels):
+        self.counters[(name, _labels(labels))] += value
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels(labels))
+        if (histogram := self.histograms.get(key)) is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name, func):
+        """Registers `func`, returning either a number or a dictionary of label dictionary -> number."""
+        self.gauges[name] = func
+
+    def cache(self, name, info):
+        """Registers a cache that counts on its own, `info` returns its (hits, misses)."""
+        self.caches[name] = info
+
+    def hit(self, cache):
+        self.cache_counts[cache][0] += 1
+
+    def miss(self, cache):
+        self.cache_counts[cache][1] += 1
+
+    def _gauge_values(self):
+        for name, func in self.gauges.items():
+            try:
+                values = func()
+            except Exception:
+                continue
+            if isinstance(values, dict):
+                for labels, value in values.items():
+                    yield name, labels, value
+            else:
+                yield name, (), values
+
+    def _cache_values(self):
+        for name, (hits, misses) in self.cache_counts.items():
+            yield name, hits, misses
+        for name, info in self.caches.items():
+            try:
+                hits, misses = info()
+            except Exception:
+                continue
+            yield name, hits, misses
+
+    def render(self) -> str:
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{_format(name, labels)} {_number(value)}")
+
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"{_format(name, labels, '_bucket', [('le', _number(bound))])} {cumulative}")
+            lines.append(f"{_format(name, labels, '_sum')} {histogram.sum:g}")
+            lines.append(f"{_format(name, labels, '_count')} {histogram.count}")
+
+        for name, labels, value in self._gauge_values():
+            lines.append(f"{_format(name, labels)} {_number(value)}")
+
+        # Samples of one metric have to stay together
+        caches = list(self._cache_values())
+        lines.extend(f"{_format('cache_hits_total', [('cache', name)])} {hits}" for name, hits, _ in caches)
+        lines.extend(f"{_format('cache_misses_total', [('cache', name)])} {misses}" for name, _, misses in caches)
+
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path=None):
+        """Writes the rendered metrics to `path`, or METRICS_PATH if not given."""
+        if not (path := path or os.environ.get("METRICS_PATH")):
+            return
+        with open(path + ".tmp", "w") as f:
+            f.write(self.render())
+        os.replace(path + ".tmp", path)
+
+    def summary(self) -> str:
+        """Short human readable overview of request latency per host and cache hit ratios."""
+        per_host = defaultdict(Histogram)
+        for (name, labels), histogram in self.histograms.items():
+            if name == "http_request_duration_seconds":
+                merged = per_host[dict(labels)["host"]]
+                merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+                merged.sum += histogram.sum
+                merged.count += histogram.count
+
+        retries, errors = defaultdict(float), defaultdict(float)
+        for (name, labels), value in self.counters.items():
+            if name == "http_retries_total":
+                retries[dict(labels)["host"]] += value
+            elif name == "http_requests_total" and not str(dict(labels).get("status", "")).startswith(("2", "3")):
+                errors[dict(labels)["host"]] += value
+
+        lines = [f"{'host':<24}{'requests':>9}{'p50':>7}{'p95':>7}{'p99':>7}{'errors':>8}{'retries':>8}"]
+        for host, histogram in sorted(per_host.items()):
+            lines.append(
+                f"{host:<24}{histogram.count:>9}{histogram.quantile(0.5):>7g}{histogram.quantile(0.95):>7g}"
+                f"{histogram.quantile(0.99):>7g}{errors[host]:>8g}{retries[host]:>8g}"
+            )
+
+        lines.append("")
+        lines.append(f"{'cache':<40}{'hits':>9}{'misses':>9}{'ratio':>7}")
+        for name, hits, misses in self._cache_values():
+            ratio = hits / (hits + misses) if hits + misses else 0
+            lines.append(f"{name:<40}{hits:>9}{misses:>9}{ratio:>7.0%}")
+
+        for name, labels, value in self._gauge_values():
+            lines.append(f"{_format(name, labels)} {_number(value)}")
+
+        return "\n".join(lines)
+
+
+metrics = Metrics()
+
+
+def endpoint(url) -> str:
+    """Turns a url into its endpoint template, e.g. /latest/universe/types/{id}/, to keep label values bounded."""
+    path = urlsplit(url).path
+    path = re.sub(r"/[0-9a-f]{40}(?=/|$)", "/{hash}", path)
+    return re.sub(r"/\d+(?=/|$)", "/{id}", path)
+
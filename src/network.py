@@ -1,16 +1,34 @@
 import asyncio
+import concurrent.futures
+import contextvars
+import functools
 import json
 import logging
+import os
 import random
 import ssl
 import string
 import tarfile
-from datetime import datetime
-from io import BytesIO
+import threading
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
 
 import aiohttp
 import certifi
-from aiocache import cached
+
+import fixtures
+import sde
+from batching import MicroBatcher
+from cache import LRUCache, cached
+from killmail_cache import KillmailCache
+from killmail_store import KillmailStore, epoch
+from metrics import endpoint, metrics
+from orderbook import PriceIndex
+from ratelimit import EsiErrorBudget, HostPolicy, Scheduler, TokenBucket
+from retry import CircuitBreaker, Retry, RetryPolicy, Throttled, shared, time_budget
+from type_store import TypeStore
 
 ssl_context = ssl.create_default_context(cafile=certifi.where())
 
@@ -18,14 +36,198 @@ ssl_context = ssl.create_default_context(cafile=certifi.where())
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-# Limit all traffic to 50 concurrent requests
-esi_semaphore = asyncio.BoundedSemaphore(50)
-error_limit = 100
-error_delay = 0
+# Every request waits for a slot from the policy of its host
+scheduler = Scheduler(
+    {
+        "esi.evetech.net": EsiErrorBudget(concurrency=50),
+        "zkillboard.com": TokenBucket(rate=1, burst=1),  # One request per second
+        "market.fuzzwork.co.uk": HostPolicy(concurrency=5),
+        "mutamarket.com": HostPolicy(concurrency=5),
+        "data.everef.net": HostPolicy(concurrency=2),
+    },
+    default=HostPolicy(concurrency=10),
+)
+
+# Connection problems are worth another attempt just like 5xx responses
+_retry_on = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)
+
+retry_policies = {
+    "esi.evetech.net": RetryPolicy(attempts=10, base=0.5, cap=15, retry_on=_retry_on),
+}
+default_retry_policy = RetryPolicy(attempts=5, base=0.5, cap=10, retry_on=_retry_on)
+
+# ESI sends the odd 502 under load even when it is fine, the third party sites are down for real much sooner
+breakers = {
+    "esi.evetech.net": CircuitBreaker(threshold=20, reset_timeout=30),
+}
+
+
+def _retrying(url, func):
+    host = urlsplit(url).hostname
+    breaker = breakers.setdefault(host, CircuitBreaker(threshold=5, reset_timeout=30))
+    return retry_policies.get(host, default_retry_policy).call(host, func, breaker)
+
+
+class ClientError(ValueError):
+    """Raised for 4xx responses, which would fail again if retried."""
+
+
+class ResponseCache:
+    """Caches json responses by url, honouring the Expires and ETag headers sent by ESI.
+
+    Fresh entries are served without a request, expired entries with an ETag are revalidated
+    with If-None-Match so ESI can answer 304 without sending the body again.
+
+    Parameters
+    ----------
+    maxsize : int
+        Number of responses to keep before evicting the least recently used one.
+    path : str
+        Optional json file the cache is loaded from on startup and saved to on shutdown.
+    skip : tuple
+        Url prefixes that are never stored, e.g. for large responses that are cached elsewhere.
+    """
+
+    def __init__(self, maxsize=10000, path=None, skip=()):
+        self.entries = LRUCache(maxsize)
+        self.path = path
+        self.skip = tuple(skip)
+
+    @staticmethod
+    def expiry(headers):
+        try:
+            return parsedate_to_datetime(headers["Expires"]).timestamp()
+        except (KeyError, TypeError, ValueError):
+            return 0.0
+
+    def fresh(self, url):
+        """Returns the cached data for `url` if it has not expired yet, otherwise None."""
+        if (entry := self.entries.get(url)) is not None and entry["expires"] > time.time():
+            return entry["data"]
+        return None
+
+    def etag(self, url):
+        if (entry := self.entries.get(url)) is not None:
+            return entry["etag"]
+        return None
+
+    def store(self, url, headers, data):
+        if url.startswith(self.skip):
+            return
+        expires = self.expiry(headers)
+        etag = headers.get("ETag")
+        if expires or etag:
+            self.entries.set(url, {"expires": expires, "etag": etag, "data": data})
+
+    def revalidated(self, url, headers):
+        """Extends the lifetime of an entry after a 304 response and returns its data."""
+        if (entry := self.entries.get(url)) is None:
+            return None
+        entry["expires"] = self.expiry(headers)
+        entry["etag"] = headers.get("ETag", entry["etag"])
+        return entry["data"]
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                for url, entry in json.load(f):
+                    if not url.startswith(self.skip):
+                        self.entries.set(url, entry)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not load response cache from {self.path}: {e}")
+
+    def save(self):
+        if not self.path:
+            return
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.entries.items(), f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+# Killmails have a cache of their own on disk, and zkillboard pages and histories are large and read once,
+# keeping them would only hold hundreds of MB in memory and in the saved cache
+response_cache = ResponseCache(
+    path=os.environ.get("HTTP_CACHE_PATH"),
+    skip=("https://esi.evetech.net/latest/killmails/", "https://zkillboard.com/"),
+)
+
+# Types and groups only change with a new game version, so they are kept on disk
+type_store = TypeStore(os.environ.get("STATIC_CACHE_PATH", "static_data.sqlite3"))
+
+# Killmails never change for a given hash, so every one fetched is kept on disk
+killmail_cache = KillmailCache(
+    os.environ.get("KILLMAIL_CACHE_PATH", "killmails.sqlite3"),
+    max_bytes=int(os.environ.get("KILLMAIL_CACHE_MAX_MB", 512)) * 1024 * 1024,
+)
+
+# Optional local killmail store, fed with everything fetched from zkillboard
+killmail_store = KillmailStore(path) if (path := os.environ.get("KILLMAIL_STORE_PATH")) else None
+
+# Optional offline index of the static data export, answering type lookups without any request
+sde_index = sde.load(os.environ.get("SDE_INDEX_PATH"))
+
+# Optional recording of every response, to be replayed with `python fixtures.py`
+recorder = fixtures.FixtureStore(path) if (path := os.environ.get("HTTP_RECORD_PATH")) else None
+
+# Optional stand-in server all requests are sent to instead of the real hosts
+upstream = os.environ.get("HTTP_UPSTREAM")
+
+# One long-lived client shared by every request, see get_session
+_session = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Returns the shared client session, creating it on first use."""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            ssl=ssl_context,
+            limit=100,  # Total open sockets
+            limit_per_host=50,  # Matches the ESI concurrency limit
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60))
+    return _session
+
+
+# Seconds the startup waits for the ESI status
+STATUS_CHECK_SECONDS = 10
+
+
+async def open_session():
+    """Creates the shared client session, called once when the bot starts."""
+    response_cache.load()
+    get_session()
+
+    try:
+        # ESI being down must not hold up the login for long, the check runs again on the next start
+        with time_budget(STATUS_CHECK_SECONDS):
+            status = await get("https://esi.evetech.net/latest/status/?datasource=tranquility")
+        if await type_store.run(type_store.check_version, status["server_version"]):
+            logger.info(f"Static data cache reset for server version {status['server_version']}")
+    except Exception as e:
+        logger.warning(f"Could not check server version for static data cache: {e}")
+
+
+async def close_session():
+    """Closes the shared client session, called once when the bot shuts down."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+    response_cache.save()
+    type_store.close()
+    killmail_cache.close()
+    if killmail_store is not None:
+        killmail_store.close()
+    metrics.dump()
 
 
 def generate_headers(url):
-    headers = {}
+    headers = {'Accept-Encoding': "gzip, deflate, br"}
 
     user_agent = "Kibana-Statistics by Larynx Austrene <larynx.austrene@gmail.com> Python-Aiohttp"
 
@@ -38,90 +240,212 @@ def generate_headers(url):
     return headers
 
 
+# GET requests currently in flight, keyed by url
+_inflight = {}
+coalesce_stats = {"requests": 0, "deduplicated": 0}
+
+
+def _forget_inflight(url, task):
+    if _inflight.get(url) is task:
+        del _inflight[url]
+
+    # Mark the exception as retrieved in case every waiter was cancelled
+    if not task.cancelled():
+        task.exception()
+
+
 async def get(url) -> dict:
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=ssl_context)) as session:
-        # Wait for ESI errors to pass
-        if "esi.evetech.net" in url:
-            global error_limit, error_delay
-            if error_limit < 1:
-                await asyncio.sleep(error_delay)
-                error_limit = 100
+    """Fetches json from `url`, sharing a single request between all callers asking for it at the same time."""
+    coalesce_stats["requests"] += 1
 
-        async with esi_semaphore:
+    if (data := response_cache.fresh(url)) is not None:
+        metrics.hit("http_response")
+        return data
+    metrics.miss("http_response")
 
-            # Retry logic with dynamic User-Agent for esi.evetech.net
-            for attempt in range(20 if "esi.evetech.net" in url else 5):
+    if (task := _inflight.get(url)) is not None:
+        coalesce_stats["deduplicated"] += 1
+    else:
+        # Run outside the context of the caller, so its deadline does not fail the request for everybody else
+        task = asyncio.get_running_loop().create_task(_get(url), context=contextvars.Context())
+        _inflight[url] = task
+        task.add_done_callback(functools.partial(_forget_inflight, url))
 
-                async with session.get(url, headers=generate_headers(url)) as response:
+    return await shared(task)
 
-                    # Handle error limit headers for esi.evetech.net
-                    if "esi.evetech.net" in url:
-                        if (current_error_limit := int(
-                                response.headers.get("X-Esi-Error-Limit-Remain", 100))) < error_limit:
-                            error_limit = min(error_limit, current_error_limit)
-                            error_delay = int(response.headers.get("X-Esi-Error-Limit-Reset", 0))
 
-                    if response.status == 200:
-                        try:
-                            return await response.json(content_type=None)
-                        except Exception as e:
-                            logger.warning(f"Error {e} with ESI {response.status}: {await response.text()}")
-                    elif 400 <= response.status <= 499:
-                        raise ValueError(f"Url {url} got {response.status} with text {await response.text()}")
+@asynccontextmanager
+async def _request(method, url, record=True, **kwargs):
+    """Sends one request once the scheduler allows it, recording its metrics.
 
-                    else:
-                        logger.warning(f"Error with ESI {response.status}: {await response.text()}")
+    With `record`, the response is saved as fixture if HTTP_RECORD_PATH is set, which needs the full body.
+    Streamed responses pass False.
+    """
+    host, path = urlsplit(url).hostname, endpoint(url)
+    target = url if upstream is None else fixtures.redirect(url, upstream)
 
-                    # Retry with backoff if esi.evetech.net
-                    if "esi.evetech.net" in url:
-                        if error_limit < 1:
-                            await asyncio.sleep(error_delay)
-                            error_limit = 100
+    queued = time.monotonic()
+    async with scheduler.slot(url) as policy:
+        started = time.monotonic()
+        metrics.observe("http_queue_seconds", started - queued, host=host)
 
-                        await asyncio.sleep(0.5 * (attempt + 1))  # Linear backoff
-                    else:
-                        await asyncio.sleep(0.25 * (attempt + 1) ** 3)  # Cubic backoff
+        status = "error"
+        try:
+            async with get_session().request(method, target, **kwargs) as response:
+                status = response.status
+                policy.observe(response.status, response.headers)
+
+                async def finish():
+                    metrics.inc("http_response_bytes_total", response.content.total_bytes, host=host)
+
+                    # Only answers worth replaying, a 304 would overwrite the recorded body
+                    if recorder is not None and record and response.status < 500 and response.status not in (304, 420, 429):
+                        recorder.record(method, url, kwargs.get("json"), response.status, response.headers, await response.read())
+
+                try:
+                    yield response
+                except Exception:
+                    # Responses the caller failed on, like the 4xx _handle raises for, are counted and recorded too
+                    await finish()
+                    raise
+                await finish()
+        finally:
+            metrics.inc("http_requests_total", host=host, endpoint=path, method=method, status=status)
+            metrics.observe("http_request_duration_seconds", time.monotonic() - started, host=host, endpoint=path)
+
+
+async def _get(url) -> dict:
+    async def attempt():
+        headers = generate_headers(url)
+        if etag := response_cache.etag(url):
+            headers['If-None-Match'] = etag
+
+        async with _request("GET", url, headers=headers) as response:
+            data = await _handle(url, response)
+            if response.status == 200:
+                response_cache.store(url, response.headers, data)
+            return data
+
+    return await _retrying(url, attempt)
+
+
+async def _handle(url, response):
+    """Returns the json body of a response, raising Retry for everything that is worth another attempt."""
+    if response.status == 304 and (data := response_cache.revalidated(url, response.headers)) is not None:
+        return data
+    elif response.status == 200:
+        try:
+            return await response.json(content_type=None)
+        except Exception as e:
+            raise Retry(f"Error {e} with {url} {response.status}: {await response.text()}")
+    elif response.status in (420, 429):
+        # The host policy already holds new requests back until Retry-After
+        raise Throttled(f"Url {url} got {response.status}")
+    elif 400 <= response.status <= 499:
+        raise ClientError(f"Url {url} got {response.status} with text {await response.text()}")
 
-            raise ValueError(f"Could not fetch data from {url}!")
+    logger.warning(f"Error with {url} {response.status}: {await response.text()}")
+    raise Retry(f"Url {url} got {response.status}")
 
 
 async def post(url, **kwargs) -> dict:
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=ssl_context)) as session:
-        # Wait for ESI error limit to pass
-        if "esi.evetech.net" in url:
-            global error_limit, error_delay
-            if error_limit < 1:
-                await asyncio.sleep(error_delay)
-                error_limit = 100
-
-        async with esi_semaphore:
-            async with session.post(url, **kwargs) as response:
-
-                # Fetch delay of lowest error limit
-                if "esi.evetech.net" in url:
-                    if (
-                            current_error_limit := int(
-                                response.headers.get("X-Esi-Error-Limit-Remain", 100))) < error_limit:
-                        error_limit = current_error_limit
-                        error_delay = int(response.headers.get("X-Esi-Error-Limit-Reset", 0))
-
-                for attempt in range(10):
-                    if response.status == 200:
-                        try:
-                            return await response.json(content_type=None)
-                        except Exception as e:
-                            logger.error(f"Error {e} with ESI {response.status}: {await response.text()}")
-                    else:
-                        logger.error(f"Error with ESI {response.status}: {await response.text()}")
-
-                    if error_limit < 1:
-                        await asyncio.sleep(error_delay)
-                        error_limit = 100
-                    await asyncio.sleep(0.25 * (attempt + 1) ** 3)  # Cubic Backoff on Error
-                raise ValueError(f"Could not fetch data from ESI!")
-
-
-@cached()
+    async def attempt():
+        async with _request("POST", url, headers=generate_headers(url), **kwargs) as response:
+            return await _handle(url, response)
+
+    return await _retrying(url, attempt)
+
+
+class EntityResolver:
+    """Resolves names to ids and ids to names in bulk through /universe/ids and /universe/names.
+
+    Single lookups made at the same time are merged into one POST per endpoint,
+    results are kept in one bounded cache shared by all name helpers.
+    """
+
+    def __init__(self, maxsize=50000):
+        self.names = LRUCache(maxsize)
+        # Names of deleted characters can be taken by new ones
+        self.ids = LRUCache(maxsize, ttl=86400)
+        # Ids ESI rejected, so they are not asked for again and again
+        self.invalid = LRUCache(maxsize, ttl=3600)
+        self.name_batcher = MicroBatcher(self._fetch_names, max_batch=1000)
+        self.id_batcher = MicroBatcher(self._fetch_ids, max_batch=500)
+
+    async def _fetch_names(self, ids) -> dict:
+        url = "https://esi.evetech.net/latest/universe/names/?datasource=tranquility"
+        try:
+            data = await post(url, json=ids)
+        except ClientError:
+            # ESI rejects the whole batch if a single id is invalid, so split it to keep the valid ones
+            if len(ids) == 1:
+                self.invalid.set(ids[0], True)
+                return {}
+            half = len(ids) // 2
+            return {**await self._fetch_names(ids[:half]), **await self._fetch_names(ids[half:])}
+
+        names = {entry["id"]: entry["name"] for entry in data}
+        for some_id, name in names.items():
+            self.names.set(some_id, name)
+        return names
+
+    async def _fetch_ids(self, names) -> dict:
+        url = "https://esi.evetech.net/latest/universe/ids/?datasource=tranquility&language=en"
+        data = await post(url, json=names)
+
+        # Keep the highest id per category, as names of deleted characters can be reused
+        matches = {name: {} for name in names}
+        for category, entries in data.items():
+            for entry in entries:
+                found = matches.setdefault(entry["name"].lower(), {})
+                found[category] = max(found.get(category, 0), entry["id"])
+
+        for name in names:
+            self.ids.set(name, matches[name])
+        return matches
+
+    async def get_name(self, some_id) -> str:
+        if (name := self.names.get(some_id)) is not None:
+            metrics.hit("entity_names")
+            return name
+        if some_id in self.invalid:
+            metrics.hit("entity_names")
+            raise ValueError(f"{some_id} is not a valid id!")
+        metrics.miss("entity_names")
+        return await self.name_batcher.get(some_id)
+
+    async def get_names(self, ids) -> dict:
+        """Returns the names of all valid `ids`, keyed by id."""
+        ids = set(ids)
+        results = await asyncio.gather(*[self.get_name(some_id) for some_id in ids], return_exceptions=True)
+        return {some_id: name for some_id, name in zip(ids, results) if not isinstance(name, Exception)}
+
+    async def get_ids(self, name) -> dict:
+        """Returns the ids matching `name` exactly, keyed by category such as "characters" or "corporations"."""
+        name = name.lower()
+        if (matches := self.ids.get(name)) is not None:
+            return matches
+        return await self.id_batcher.get(name)
+
+
+resolver = EntityResolver()
+
+metrics.gauge("esi_error_limit_remain", lambda: scheduler.policies["esi.evetech.net"].remain)
+metrics.gauge("http_requests_in_flight", lambda: len(_inflight))
+metrics.gauge("http_coalesced_requests_total", lambda: coalesce_stats["deduplicated"])
+metrics.gauge("circuit_breaker_open", lambda: {
+    (("host", host),): int(breaker.opened_at is not None) for host, breaker in breakers.items()
+})
+metrics.gauge("batched_keys_total", lambda: {
+    (("batcher", "item_price"),): price_batcher.keys,
+    (("batcher", "entity_names"),): resolver.name_batcher.keys,
+    (("batcher", "entity_ids"),): resolver.id_batcher.keys,
+})
+metrics.cache("killmails", lambda: (killmail_cache.hits, killmail_cache.misses))
+metrics.gauge("order_book_age_seconds", lambda: order_book.age)
+metrics.gauge("order_book_types", lambda: len(order_book))
+
+
 async def id_lookup(string, return_type):
     """
     Tries to find an ID related to the input.
@@ -144,9 +468,15 @@ async def id_lookup(string, return_type):
     try:
         return int(string)
     except ValueError:
-        url = 'https://esi.evetech.net/latest/universe/ids/?datasource=tranquility&language=en'
-        data = await post(url, json=[string])
-        return max(data[return_type], key=lambda x: x["id"])["id"]
+        matches = await resolver.get_ids(string)
+        if return_type not in matches:
+            raise ValueError(f"Could not find any {return_type} named {string}!")
+        return matches[return_type]
+
+
+async def get_names(ids) -> dict:
+    """Returns the names of any mix of character, corporation, alliance, system or type ids, keyed by id."""
+    return await resolver.get_names(ids)
 
 
 async def get_hash(kill_id):
@@ -155,8 +485,14 @@ async def get_hash(kill_id):
 
 
 async def get_kill(kill_id, kill_hash):
+    if (kill := await killmail_cache.get(kill_id, kill_hash)) is not None:
+        return kill
+
     url = f"https://esi.evetech.net/latest/killmails/{kill_id}/{kill_hash}/?datasource=tranquility"
-    return await get(url)
+    kill = await get(url)
+    if "killmail_time" in kill:
+        killmail_cache.put(kill_id, kill_hash, kill)
+    return kill
 
 
 async def gather_kills(kills):
@@ -170,6 +506,25 @@ async def gather_kills(kills):
             continue
 
 
+async def get_pages(url) -> list:
+    """Fetches every page of a paginated ESI endpoint, all pages after the first one in parallel.
+
+    The pages bypass the response cache, which is meant for small responses and not whole order books.
+    """
+    async def fetch(page):
+        page_url = f"{url}&page={page}"
+
+        async def attempt():
+            async with _request("GET", page_url, headers=generate_headers(page_url)) as response:
+                return await _handle(page_url, response), int(response.headers.get("X-Pages", 1))
+
+        return await _retrying(page_url, attempt)
+
+    first, pages = await fetch(1)
+    rest = await asyncio.gather(*(fetch(page) for page in range(2, pages + 1)))
+    return [first, *(data for data, _ in rest)]
+
+
 async def get_kill_page(url, page):
     page_url = f"{url}/page/{page}/"
     page_data = await get(page_url)
@@ -187,165 +542,335 @@ async def get_kill_page(url, page):
 
 
 # Function to get all kills from a zkb link in timeframe
-async def fetch_kill_until(url, start):
+async def fetch_kill_until(url, start, workers=20):
     """Gets all killmails after a certain timestamp
 
+    The next zkillboard page is fetched while a bounded pool of workers resolves the killmails of the
+    current one from ESI. Once a killmail older than `start` shows up, no further pages are fetched and
+    queued work for later pages is dropped.
+
     Parameters
     ----------
     url : str
         The zkillboard.com url to fetch kills from.
     start : datetime
         The oldest allowed timestamp for a valid killmail.
+    workers : int
+        How many killmails are fetched from ESI at the same time.
     """
+    start = epoch(start)
+    last_page = 100  # Pages after this one are not needed anymore
 
-    reached_end = False
-
-    for page in range(1, 101):
-        # Make sure we fetch at most one page per second
-        kill_hashes, _ = await asyncio.gather(get_kill_page(url, page), asyncio.sleep(1))
-
-        # Ensure we do not continue after empty response
-        if len(kill_hashes) == 0:
-            break
-
-        async for kill in gather_kills(kill_hashes):
-            if "killmail_time" in kill:
-                # Check if we can stop
-                time = datetime.strptime(kill['killmail_time'], '%Y-%m-%dT%H:%M:%SZ')
-                if start > time:
-                    reached_end = True
+    pages = asyncio.Queue(maxsize=1)  # Holds the next page while the current one is worked on
+    jobs = asyncio.Queue(maxsize=2 * workers)
+    results = asyncio.Queue(maxsize=2 * workers)
 
-                yield kill
+    async def fetch_pages():
+        try:
+            page = 1
+            # Ensure we do not continue once we are past the start, or after an empty response
+            while page <= last_page:
+                if len(kill_hashes := await get_kill_page(url, page)) == 0 or page > last_page:
+                    break
+                await pages.put((page, kill_hashes))
+                page += 1
+        except Exception as e:
+            await results.put(e)
+        await pages.put(None)
+
+    async def dispatch():
+        while (item := await pages.get()) is not None:
+            page, kill_hashes = item
+            for kill in kill_hashes.items():
+                await jobs.put((page, *kill))
+        for _ in range(workers):
+            await jobs.put(None)
+
+    async def work():
+        while (job := await jobs.get()) is not None:
+            page, kill_id, kill_hash = job
+            if page > last_page:
+                continue
+            try:
+                await results.put((page, await get_kill(kill_id, kill_hash)))
+            except ValueError:
+                # Skip this one due to ESI Error
+                continue
+            except Exception as e:
+                # Anything else, like a passed deadline, ends the whole fetch
+                await results.put(e)
+                return
+        await results.put(None)
+
+    tasks = [asyncio.ensure_future(fetch_pages()), asyncio.ensure_future(dispatch())]
+    tasks += [asyncio.ensure_future(work()) for _ in range(workers)]
+    fetched = []
 
-        if reached_end:
-            break
+    try:
+        finished_workers = 0
+        while finished_workers < workers:
+            if (result := await results.get()) is None:
+                finished_workers += 1
+                continue
+            if isinstance(result, Exception):
+                raise result
+
+            page, kill = result
+            if "killmail_time" not in kill:
+                continue
+
+            if killmail_store is not None:
+                # Handed to the store a page at a time, so a long fetch never holds all its kills
+                fetched.append(kill)
+                if len(fetched) >= 200:
+                    killmail_store.add_later(fetched)
+                    fetched = []
+
+            if epoch(kill["killmail_time"]) < start:
+                # Pages are sorted by age, so nothing after the page of this kill can be recent enough
+                last_page = min(last_page, page)
+                continue
+
+            yield kill
+    finally:
+        for task in tasks:
+            task.cancel()
+
+        if fetched:
+            killmail_store.add_later(fetched)
+
+
+class _StreamStopped(Exception):
+    pass
+
+
+class _ThreadedBodyReader:
+    """Blocking file-like view on a response body, read from a worker thread while the loop keeps running."""
+
+    def __init__(self, content, loop, stop):
+        self.content = content
+        self.loop = loop
+        self.stop = stop
+        self.buffer = bytearray()
+        self.eof = False
+
+    def _wait(self, coroutine):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        # Poll instead of waiting on the result, its errors can be timeouts of their own, e.g. from reading the body
+        while not concurrent.futures.wait([future], timeout=0.5).done:
+            if self.stop.is_set():
+                future.cancel()
+                raise _StreamStopped()
+        return future.result()
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            if chunk := self._wait(self.content.readany()):
+                self.buffer.extend(chunk)
+            else:
+                self.eof = True
+
+        size = len(self.buffer) if size < 0 else size
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+def _parse_killmail_archive(reader, queue, batch_size=64):
+    """Walks a tar.bz2 stream member by member, handing parsed killmails to the loop in batches."""
+    batch = []
+    try:
+        with tarfile.open(fileobj=reader, mode="r|bz2") as tar:
+            for member in tar:
+                if member.isfile():
+                    batch.append(json.loads(tar.extractfile(member).read()))
+                if len(batch) >= batch_size:
+                    reader._wait(queue.put(batch))
+                    batch = []
+        reader._wait(queue.put(batch))
+        reader._wait(queue.put(None))
+    except _StreamStopped:
+        pass
+    except Exception as e:
+        if not reader.stop.is_set():
+            reader._wait(queue.put(e))
 
 
 # Alternative ways to get bulk killmails
 async def get_everef_kills(day_string):
-    url = f"https://data.everef.net/killmails/{day_string[:4]}/killmails-{day_string[:4]}-{day_string[4:6]}-{day_string[6:8]}.tar.bz2"
-    async with aiohttp.ClientSession() as session:
-        for attempt in range(5):
+    """Streams all killmails of one day from the everef archive.
 
-            async with session.get(url) as response:
-                if response.status == 200:
-                    data = await response.read()
-                    with tarfile.open(fileobj=BytesIO(data), mode='r:bz2') as tar:
-                        for member in tar.getmembers():
-                            if member.isfile():
-                                yield json.loads(tar.extractfile(member).read())
-                    return
+    The archive is downloaded, decompressed and parsed chunk by chunk in a worker thread,
+    so memory use stays flat and the event loop stays responsive.
 
-            await asyncio.sleep(0.25 * (attempt + 1) ** 3)  # Cubic backoff
+    Parameters
+    ----------
+    day_string : str
+        The day in YYYYMMDD format.
+    """
+    url = f"https://data.everef.net/killmails/{day_string[:4]}/killmails-{day_string[:4]}-{day_string[4:6]}-{day_string[6:8]}.tar.bz2"
+    loop = asyncio.get_running_loop()
+    for attempt in range(5):
+
+        # Streaming a whole day can take far longer than the session timeout, only a stalled read is an error
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=60)
+        async with _request("GET", url, record=False, headers=generate_headers(url), timeout=timeout) as response:
+            if response.status == 200:
+                # A small queue holds the parser back while the consumer is busy
+                queue = asyncio.Queue(maxsize=4)
+                stop = threading.Event()
+                reader = _ThreadedBodyReader(response.content, loop, stop)
+                loop.run_in_executor(None, _parse_killmail_archive, reader, queue)
+
+                try:
+                    while (batch := await queue.get()) is not None:
+                        if isinstance(batch, Exception):
+                            raise batch
+                        for kill in batch:
+                            yield kill
+                finally:
+                    stop.set()
+                return
+
+        await asyncio.sleep(default_retry_policy.backoff(attempt))
 
     raise ValueError(f"Could not fetch data from Everef!")
 
 
-async def get_days():
-    url = "https://zkillboard.com/api/history/totals.json"
+async def get_item_price_history(type_id, region_id=10000002):
+    url = f"https://esi.evetech.net/latest/markets/{region_id}/history/?datasource=tranquility&type_id={type_id}"
     return await get(url)
 
 
-async def get_hashes(day):
-    url = f"https://zkillboard.com/api/history/{day}.json"
-    return await get(url)
+# With PRICE_SOURCE=orderbook, prices come from a snapshot of the whole regional order book instead of fuzzwork
+order_book_enabled = os.environ.get("PRICE_SOURCE", "fuzzwork") == "orderbook"
+ORDER_BOOK_REGION = int(os.environ.get("ORDER_BOOK_REGION", 10000002))
+# ESI refreshes the order book every 5 minutes
+ORDER_BOOK_TTL = 300
+order_book = None
 
 
-@cached()
-async def get_corporation_name(corporation_id):
-    url = f"https://esi.evetech.net/latest/corporations/{corporation_id}/"
-    return (await get(url))["name"]
+def _current_order_book():
+    """Returns the order book snapshot, or None to use fuzzwork while there is none or it is too old."""
+    if order_book is None or order_book.age > PRICE_STALE_TTL:
+        return None
+    return order_book
 
 
-@cached()
-async def get_alliance_name(alliance_id):
-    url = f"https://esi.evetech.net/latest/alliances/{alliance_id}/"
-    return (await get(url))["name"]
+async def refresh_order_book(region_id=ORDER_BOOK_REGION):
+    """Downloads every order of `region_id` and replaces the order book snapshot with them."""
+    global order_book
+    url = f"https://esi.evetech.net/latest/markets/{region_id}/orders/?datasource=tranquility&order_type=all"
+    started = time.monotonic()
+    pages = await get_pages(url)
 
+    # Sorting a few hundred thousand orders would block the event loop for too long
+    orders = [order for page in pages for order in page]
+    loop = asyncio.get_running_loop()
+    order_book = await loop.run_in_executor(None, PriceIndex, region_id, orders)
+    logger.info(f"Loaded {len(orders)} orders of {len(order_book)} types in {time.monotonic() - started:.1f}s")
 
-@cached()
-async def get_character_name(character_id):
-    url = f"https://esi.evetech.net/latest/characters/{character_id}/"
-    return (await get(url))["name"]
 
+# Prices are cached for a few minutes, as fuzzwork only refreshes its aggregates every 30 minutes
+PRICE_TTL = 300
+# Older prices are still served while a refresh runs in the background
+PRICE_STALE_TTL = 3600
 
-async def get_item_price_history(type_id, region_id=10000002):
-    url = f"https://esi.evetech.net/latest/markets/{region_id}/history/?datasource=tranquility&type_id={type_id}"
-    return await get(url)
+
+async def _fetch_item_prices(type_ids) -> dict:
+    """Fetches the minimum Jita sell price of many types with one aggregates request."""
+    url = f"https://market.fuzzwork.co.uk/aggregates/?region=10000002&types={','.join(map(str, type_ids))}"
+    data = await get(url)
+
+    prices = {}
+    for type_id in type_ids:
+        price = data.get(str(type_id), {}).get("sell", {}).get("min", 0)
+        # If there are no items for sale then the api might return all 0 as integer
+        # This means no items available. We set the price to infinite.
+        if type(price) == int and price == 0:
+            prices[type_id] = float("inf")
+        else:
+            prices[type_id] = float(price)
+
+    return prices
+
+
+# Merges concurrent get_item_price calls into one request
+price_batcher = MicroBatcher(_fetch_item_prices, delay=0.05, max_batch=200)
+
+
+@cached(maxsize=10000, ttl=PRICE_TTL, stale_ttl=PRICE_STALE_TTL, name="item_price")
+async def _fuzzwork_price(type_id):
+    return await price_batcher.get(type_id)
+
+
+async def refresh_item_prices(type_ids):
+    """Fetches the current prices of `type_ids` in bulk, whether or not the cached ones expired."""
+    if _current_order_book() is not None:
+        return
+    # The batcher merges the refreshes into as few requests as possible
+    await asyncio.gather(*(_fuzzwork_price.refresh(type_id) for type_id in type_ids))
 
 
 async def get_item_price(type_id):
-    url = f"https://market.fuzzwork.co.uk/aggregates/?region=10000002&types={type_id}"
-    price = (await get(url)).get(str(type_id), {}).get("sell", {}).get("min", 0)
-    # If there are no items for sale then the api might return all 0 as integer
-    # This means no items available. We set the price to infinite.
-    if type(price) == int and price == 0:
-        return float("inf")
+    if (book := _current_order_book()) is not None:
+        metrics.hit("order_book_price")
+        return book.min_sell(type_id)
 
-    return float(price)
+    return await _fuzzwork_price(type_id)
 
 
-@cached()
 async def get_corp_name(corporation_id):
-    url = f"https://esi.evetech.net/latest/corporations/{corporation_id}/"
-    return (await get(url))["name"]
+    return await resolver.get_name(corporation_id)
 
 
-@cached()
 async def get_alliance_name(alliance_id):
-    url = f"https://esi.evetech.net/latest/alliances/{alliance_id}/"
-    return (await get(url))["name"]
+    return await resolver.get_name(alliance_id)
 
 
-@cached()
+@cached(maxsize=2000, ttl=3600, negative=(ClientError,), negative_ttl=3600)
 async def get_alliance_corporations(alliance_id):
     url = f"https://esi.evetech.net/latest/alliances/{alliance_id}/corporations/"
     return await get(url)
 
 
-@cached()
+@cached(maxsize=10000, ttl=3600, negative=(ClientError,), negative_ttl=3600)
 async def get_corp_alliance(corporation_id):
     url = f"https://esi.evetech.net/latest/corporations/{corporation_id}/"
     return (await get(url)).get("alliance_id", 0)
 
 
-@cached()
 async def get_system_name(system_id):
-    url = f"https://esi.evetech.net/latest/universe/systems/{system_id}/"
-    return (await get(url))["name"]
+    return await resolver.get_name(system_id)
 
 
-@cached()
+@cached(maxsize=10000, negative=(ClientError,), negative_ttl=3600)
 async def get_system_security(system_id):
     url = f"https://esi.evetech.net/latest/universe/systems/{system_id}/"
     return (await get(url))["security_status"]
 
 
-@cached()
 async def get_character_name(character_id):
-    url = f"https://esi.evetech.net/latest/characters/{character_id}/"
-    return (await get(url))["name"]
+    return await resolver.get_name(character_id)
 
 
-@cached()
+@cached(maxsize=20000, ttl=3600, negative=(ClientError,), negative_ttl=3600)
 async def get_character_corporation(character_id):
     url = f"https://esi.evetech.net/latest/characters/{character_id}/"
     return (await get(url))["corporation_id"]
 
 
-@cached()
 async def get_item_name(item_id):
-    url = f"https://esi.evetech.net/latest/universe/types/{item_id}/"
-    return (await get(url))["name"]
+    return await resolver.get_name(item_id)
 
 
-@cached()
+@cached(maxsize=10000, ttl=3600, negative=(ClientError,), negative_ttl=3600)
 async def get_corp_member_count(corporation_id):
     url = f"https://esi.evetech.net/latest/corporations/{corporation_id}/"
     return (await get(url))["member_count"]
 
 
-@cached()
+@cached(maxsize=10000, ttl=86400, negative=(ClientError,), negative_ttl=3600)
 async def get_jumps(origin, destination):
     url = f"https://esi.evetech.net/latest/route/{origin}/{destination}/"
     return len(await get(url))
@@ -361,25 +886,53 @@ async def get_hashes(day):
     return await get(url)
 
 
+async def _get_static_data(kind, url_template, some_ids):
+    """Reads static data from the type store, fetching and storing all misses at once."""
+    some_ids = set(some_ids)
+    found = await type_store.run(type_store.get, kind, some_ids)
+
+    if missing := [some_id for some_id in some_ids if some_id not in found]:
+        fetched = dict(zip(missing, await asyncio.gather(*[get(url_template.format(i)) for i in missing])))
+        await type_store.run(type_store.put, kind, fetched)
+        found.update(fetched)
+
+    return found
+
+
+async def get_items_data(type_ids) -> dict:
+    """Returns the ESI type data for many types at once, keyed by type_id."""
+    return await _get_static_data("types", "https://esi.evetech.net/latest/universe/types/{}/", type_ids)
+
+
+async def get_groups_data(group_ids) -> dict:
+    """Returns the ESI group data for many groups at once, keyed by group_id."""
+    return await _get_static_data("groups", "https://esi.evetech.net/latest/universe/groups/{}/", group_ids)
+
+
 async def get_item_data(type_id):
-    url = f"https://esi.evetech.net/latest/universe/types/{type_id}/"
-    return await get(url)
+    return (await get_items_data([type_id]))[type_id]
 
 
 async def get_group_data(group_id):
-    url = f"https://esi.evetech.net/latest/universe/groups/{group_id}/"
-    return await get(url)
+    return (await get_groups_data([group_id]))[group_id]
 
 
 async def get_group_id(type_id):
+    if sde_index is not None and (group_id := sde_index.group_id(type_id)) is not None:
+        return group_id
     return (await get_item_data(type_id))["group_id"]
 
 
 async def get_category_id(type_id):
+    if sde_index is not None and (category_id := sde_index.category_id(type_id)) is not None:
+        return category_id
     return (await get_group_data(await get_group_id(type_id)))["category_id"]
 
 
 async def get_dogma_attributes(type_id):
+    if sde_index is not None and (attributes := sde_index.dogma_attributes(type_id)) is not None:
+        return attributes
+
     out = {}
     for item in (await get_item_data(type_id))["dogma_attributes"]:
         out[int(item["attribute_id"])] = item["value"]
@@ -387,6 +940,9 @@ async def get_dogma_attributes(type_id):
 
 
 async def get_dogma_attribute(type_id, attribute_id):
+    if sde_index is not None and type_id in sde_index:
+        return sde_index.dogma_attribute(type_id, attribute_id)
+
     for attribute in (await get_item_data(type_id))["dogma_attributes"]:
         if attribute["attribute_id"] == attribute_id:
             return float(attribute["value"])
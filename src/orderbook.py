@@ -0,0 +1,80 @@
+import time
+from collections import defaultdict
+from typing import NamedTuple
+
+
+class TypePrices(NamedTuple):
+    min_sell: float
+    percentile: float  # Average price of the cheapest `share` of the sell volume, like the fuzzwork percentile
+    depth: int  # Items for sale in total
+    sell_orders: int
+    max_buy: float
+
+
+def _percentile(sells, share):
+    """Volume weighted average price of the cheapest `share` of the volume of `sells`, sorted (price, volume) pairs."""
+    wanted = max(1, sum(volume for _, volume in sells) * share)
+    cost = taken = 0
+    for price, volume in sells:
+        volume = min(volume, wanted - taken)
+        cost += price * volume
+        taken += volume
+        if taken >= wanted:
+            break
+    return cost / taken
+
+
+class PriceIndex:
+    """Prices of every type in a snapshot of the order book of one region.
+
+    Parameters
+    ----------
+    region_id : int
+        Region the orders are from.
+    orders : iterable
+        Orders as returned by ESI /markets/{region_id}/orders/.
+    share : float
+        Share of the sell volume the percentile price is taken over.
+    """
+
+    def __init__(self, region_id, orders, share=0.05):
+        self.region_id = region_id
+        self.created = time.time()
+
+        sells = defaultdict(list)
+        buys = defaultdict(float)
+        for order in orders:
+            if order["is_buy_order"]:
+                buys[order["type_id"]] = max(buys[order["type_id"]], order["price"])
+            else:
+                sells[order["type_id"]].append((order["price"], order["volume_remain"]))
+
+        self.prices = {}
+        for type_id in sells.keys() | buys.keys():
+            type_sells = sorted(sells.get(type_id, ()))
+            if type_sells:
+                self.prices[type_id] = TypePrices(
+                    min_sell=type_sells[0][0],
+                    percentile=_percentile(type_sells, share),
+                    depth=sum(volume for _, volume in type_sells),
+                    sell_orders=len(type_sells),
+                    max_buy=buys.get(type_id, 0.0),
+                )
+            else:
+                self.prices[type_id] = TypePrices(float("inf"), float("inf"), 0, 0, buys[type_id])
+
+    @property
+    def age(self):
+        return time.time() - self.created
+
+    def get(self, type_id) -> TypePrices | None:
+        return self.prices.get(type_id)
+
+    def min_sell(self, type_id) -> float:
+        """Returns the cheapest sell order of a type, infinite if nobody sells it."""
+        if (prices := self.prices.get(type_id)) is None:
+            return float("inf")
+        return prices.min_sell
+
+    def __len__(self):
+        return len(self.prices)
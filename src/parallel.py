@@ -0,0 +1,75 @@
+"""Process pool for the CPU heavy optimizers, so they use every core and never block the event loop."""
+import asyncio
+import concurrent.futures
+import functools
+import heapq
+import multiprocessing
+import os
+import time
+
+from retry import DeadlineExceeded, deadline
+
+# Processes searching in parallel, one per core by default
+WORKERS = int(os.environ.get("OPTIMIZER_WORKERS", os.cpu_count() or 1))
+
+_pool = None
+
+
+def get_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # Forking the bot would copy its event loop, sockets and threads into every worker
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=WORKERS, mp_context=multiprocessing.get_context(method)
+        )
+    return _pool
+
+
+async def run(func, *args, **kwargs):
+    """Runs `func(*args, **kwargs)` in a worker process, `func` and its arguments have to be picklable.
+
+    Gives up at the deadline of the caller, the worker should watch `stop_at` to stop by itself.
+    """
+    loop = asyncio.get_running_loop()
+    timeout = asyncio.timeout_at(deadline.get())
+    try:
+        async with timeout:
+            return await loop.run_in_executor(get_pool(), functools.partial(func, *args, **kwargs))
+    except TimeoutError:
+        if timeout.expired():
+            raise DeadlineExceeded("No time left to finish the search.") from None
+        raise
+
+
+def stop_at():
+    """Returns the deadline of the caller as wall clock time, which worker processes can compare against."""
+    if (end := deadline.get()) is None:
+        return None
+    return time.time() + end - asyncio.get_running_loop().time()
+
+
+async def map_shards(func, shards, *args, **kwargs) -> list:
+    """Runs `func(shard, *args, **kwargs)` for every shard in parallel, returns the results in order of the shards."""
+    return await asyncio.gather(*(run(func, shard, *args, **kwargs) for shard in shards))
+
+
+def balanced(weights, shards):
+    """Splits the indices of `weights` into at most `shards` sorted lists of about equal total weight.
+
+    The heaviest index goes to the lightest shard first, so a few huge indices do not end up together.
+    """
+    loads = [(0, shard) for shard in range(shards)]
+    parts = [[] for _ in range(shards)]
+    for index in sorted(range(len(weights)), key=weights.__getitem__, reverse=True):
+        load, shard = heapq.heappop(loads)
+        parts[shard].append(index)
+        heapq.heappush(loads, (load + weights[index], shard))
+    return [sorted(part) for part in parts if part]
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
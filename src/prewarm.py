@@ -0,0 +1,61 @@
+"""Keeps the market data behind the slash commands warm, so commands rarely wait for upstream.
+
+Every job refreshes its items once per interval, spread evenly over it, so no host sees a burst.
+The host policies of the scheduler still apply to every request.
+"""
+import asyncio
+import logging
+import os
+import random
+
+from metrics import metrics
+from network import ORDER_BOOK_REGION, ORDER_BOOK_TTL, order_book_enabled, refresh_order_book
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+# Jobs the extensions register when they load, by name: seconds between refreshes of the same item, items,
+# coroutine function warming one item, and optionally the seconds until the first run, random by default
+JOBS = {}
+
+
+def register(name, interval, items, warm, offset=None):
+    """Refreshes every one of `items` with `warm(item)` once per `interval` seconds, from start() on.
+
+    Extensions register their jobs in their setup, so the jobs warm the very module objects the commands use.
+    """
+    JOBS[name] = (interval, list(items), warm, offset)
+
+
+async def _run(name, interval, items, warm, offset=None):
+    loop = asyncio.get_running_loop()
+
+    # Start at a random point, so the jobs do not all hit upstream at once
+    await asyncio.sleep(random.uniform(0, interval / len(items)) if offset is None else offset)
+
+    while True:
+        started = loop.time()
+        for index, item in enumerate(items):
+            await asyncio.sleep(max(0.0, started + index * interval / len(items) - loop.time()))
+            try:
+                await warm(item)
+                metrics.inc("prewarm_runs_total", job=name, result="ok")
+            except Exception as e:
+                metrics.inc("prewarm_runs_total", job=name, result="error")
+                logger.warning(f"Could not prewarm {name} {getattr(item, '__name__', item)}: {e}")
+
+        await asyncio.sleep(max(0.0, started + interval - loop.time()))
+
+
+def start():
+    """Starts all prewarm jobs, returns their tasks.
+
+    PREWARM=0 turns the jobs off, except for the order book snapshot, which is the only price source with
+    PRICE_SOURCE=orderbook.
+    """
+    jobs = [(name, *job) for name, job in JOBS.items() if job[1]] if os.environ.get("PREWARM", "1") != "0" else []
+    if order_book_enabled:
+        # Right away, fuzzwork has to stand in for it until the first snapshot is loaded
+        jobs.append(("order_book", ORDER_BOOK_TTL, [ORDER_BOOK_REGION], refresh_order_book, 0))
+    return [asyncio.create_task(_run(*job), name=f"prewarm-{job[0]}") for job in jobs]
@@ -0,0 +1,128 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+
+
+class HostPolicy:
+    """Caps the number of concurrent requests to one host and honours Retry-After on 420 / 429."""
+
+    def __init__(self, concurrency=10):
+        self.semaphore = asyncio.BoundedSemaphore(concurrency)
+        self.blocked_until = 0.0
+
+    async def acquire(self):
+        await self.semaphore.acquire()
+        try:
+            while (delay := self.blocked_until - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+    def release(self):
+        self.semaphore.release()
+
+    def observe(self, status, headers):
+        """Updates the policy with the status and headers of a finished response."""
+        if status in (420, 429):
+            try:
+                retry_after = float(headers.get("Retry-After", 1))
+            except ValueError:
+                retry_after = 1
+            self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+
+class TokenBucket(HostPolicy):
+    """Allows on average `rate` requests per second with bursts of up to `burst` requests."""
+
+    def __init__(self, rate, burst=1, concurrency=2):
+        super().__init__(concurrency)
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    async def acquire(self):
+        await super().acquire()
+        try:
+            # The lock keeps waiters in order, so nobody starves while sleeping for a token
+            async with self.lock:
+                self._refill()
+                if self.tokens < 1:
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+                    self._refill()
+                self.tokens -= 1
+        except BaseException:
+            super().release()
+            raise
+
+
+class EsiErrorBudget(HostPolicy):
+    """Tracks the ESI error limit from the X-Esi-Error-Limit-Remain / -Reset headers.
+
+    New requests are held back once fewer than `reserve` errors remain in the current window,
+    until ESI resets the window.
+    """
+
+    def __init__(self, concurrency=50, reserve=5, limit=100):
+        super().__init__(concurrency)
+        self.reserve = reserve
+        self.limit = limit
+        self.remain = limit
+        self.reset_at = 0.0
+
+    async def acquire(self):
+        await super().acquire()
+        try:
+            while self.remain <= self.reserve and (delay := self.reset_at - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+
+            if self.reset_at <= time.monotonic():
+                self.remain = max(self.remain, self.limit)
+        except BaseException:
+            self.release()
+            raise
+
+    def observe(self, status, headers):
+        super().observe(status, headers)
+
+        if "X-Esi-Error-Limit-Remain" not in headers:
+            return
+
+        remain = int(headers.get("X-Esi-Error-Limit-Remain", self.limit))
+        reset_at = time.monotonic() + int(headers.get("X-Esi-Error-Limit-Reset", 0))
+
+        # Responses of the same window can arrive out of order, so only trust the lowest value
+        if reset_at > self.reset_at + 1:
+            self.remain = remain
+        else:
+            self.remain = min(self.remain, remain)
+        self.reset_at = max(self.reset_at, reset_at)
+
+
+class Scheduler:
+    """Routes every request through the policy of its host."""
+
+    def __init__(self, policies, default=None):
+        self.policies = policies
+        self.default = default or HostPolicy()
+
+    def policy(self, url) -> HostPolicy:
+        return self.policies.get(urlsplit(url).hostname, self.default)
+
+    @asynccontextmanager
+    async def slot(self, url):
+        """Waits until the host of `url` may be queried, yielding its policy to observe the response."""
+        policy = self.policy(url)
+        await policy.acquire()
+        try:
+            yield policy
+        finally:
+            policy.release()
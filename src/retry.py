@@ -0,0 +1,182 @@
+import asyncio
+import contextvars
+import random
+import time
+from contextlib import contextmanager
+
+from metrics import metrics
+
+# Loop time by which the current command has to be done, None for no deadline.
+# Tasks copy the context they are created in, so everything a command gathers shares its deadline.
+deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """The command that started this request ran out of time."""
+
+
+class CircuitOpen(ValueError):
+    """The host failed too often recently and is not queried until it had time to recover."""
+
+
+class Retry(Exception):
+    """Raised by a request to have it retried, e.g. on a 5xx response."""
+
+
+class Throttled(Retry):
+    """Retry that does not count against the circuit breaker, e.g. on 420 / 429."""
+
+
+def remaining():
+    """Returns the seconds left until the deadline, or None if there is none."""
+    if (current := deadline.get()) is None:
+        return None
+    return current - asyncio.get_running_loop().time()
+
+
+@contextmanager
+def time_budget(seconds):
+    """Sets a deadline `seconds` from now for everything awaited inside, never extending an earlier one."""
+    new = asyncio.get_running_loop().time() + seconds
+    if (current := deadline.get()) is not None:
+        new = min(new, current)
+
+    token = deadline.set(new)
+    try:
+        yield
+    finally:
+        deadline.reset(token)
+
+
+async def shared(task):
+    """Waits for a task shared between many callers, giving up at the deadline of the current caller only.
+
+    Shared tasks run in a context of their own, so the deadline of whoever started them does not cut them short
+    for everybody else. Shielded, so one caller giving up does not cancel the task for the others either.
+    """
+    timeout = asyncio.timeout_at(deadline.get())
+    try:
+        async with timeout:
+            return await asyncio.shield(task)
+    except TimeoutError:
+        if timeout.expired():
+            raise DeadlineExceeded("No time left to wait for a shared request.") from None
+        raise
+
+
+class CircuitBreaker:
+    """Fails fast after `threshold` failures in a row, letting a single trial request through every `reset_timeout`."""
+
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if self.trial else "open"
+
+    def check(self, host):
+        if self.opened_at is None:
+            return
+        if self.trial or time.monotonic() - self.opened_at < self.reset_timeout:
+            raise CircuitOpen(f"{host} is failing, not trying again for now.")
+        self.trial = True
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def failure(self):
+        self.failures += 1
+        self.trial = False
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+    def abandon(self):
+        """The request ended without telling anything about the host, e.g. it was cancelled."""
+        self.trial = False
+
+
+class RetryPolicy:
+    """Retries a request with exponential backoff and full jitter.
+
+    Parameters
+    ----------
+    attempts : int
+        How often a request is tried in total.
+    base : float
+        Upper bound in seconds of the first backoff, doubled with every attempt.
+    cap : float
+        Upper bound in seconds of any backoff.
+    retry_on : tuple
+        Exceptions besides Retry that are worth another attempt, such as connection errors.
+    """
+
+    def __init__(self, attempts=5, base=0.5, cap=10.0, retry_on=()):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.retry_on = (Retry, TimeoutError, *retry_on)
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    @staticmethod
+    def _deadline_exceeded(host):
+        metrics.inc("http_deadline_exceeded_total", host=host)
+        return DeadlineExceeded(f"No time left for {host}.")
+
+    async def call(self, host, func, breaker=None):
+        """Awaits `func()` until it succeeds, the attempts are used up or the deadline passed."""
+        error = None
+        for attempt in range(self.attempts):
+            if (left := remaining()) is not None and left <= 0:
+                raise self._deadline_exceeded(host) from error
+            if breaker is not None:
+                try:
+                    breaker.check(host)
+                except CircuitOpen:
+                    metrics.inc("http_circuit_open_total", host=host)
+                    raise
+
+            try:
+                async with asyncio.timeout_at(deadline.get()):
+                    result = await func()
+            except Throttled as e:
+                error = e
+                if breaker is not None:
+                    breaker.abandon()
+            except self.retry_on as e:
+                if (left := remaining()) is not None and left <= 0:
+                    raise self._deadline_exceeded(host) from e
+                error = e
+                if breaker is not None:
+                    breaker.failure()
+            except Exception:
+                # The host answered, just not with anything worth retrying
+                if breaker is not None:
+                    breaker.success()
+                raise
+            except BaseException:
+                if breaker is not None:
+                    breaker.abandon()
+                raise
+            else:
+                if breaker is not None:
+                    breaker.success()
+                return result
+
+            metrics.inc("http_retries_total", host=host, reason=type(error).__name__)
+            if attempt + 1 < self.attempts:
+                delay = self.backoff(attempt)
+                if (left := remaining()) is not None and left <= delay:
+                    raise self._deadline_exceeded(host) from error
+                await asyncio.sleep(delay)
+
+        raise ValueError(f"Could not fetch data from {host} after {self.attempts} attempts: {error}") from error
@@ -0,0 +1,218 @@
+"""Compact, memory-mapped index over the static data export (SDE).
+
+Build the index once from a downloaded export, then point SDE_INDEX_PATH at it:
+
+    python sde.py reference-data-latest.tar.xz sde.idx
+
+Supported exports are the everef reference data (types.json, groups.json) and the CCP SDE in
+json lines format (types.jsonl, groups.jsonl, typeDogma.jsonl), either as archive or unpacked directory.
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import tarfile
+import zipfile
+from array import array
+from bisect import bisect_left
+
+MAGIC = b"SDEI"
+VERSION = 1
+
+# magic, version, number of types, groups, attribute rows and effect rows
+HEADER = struct.Struct("<4sIIIII")
+
+
+def _read_export(path):
+    """Yields (file name, content) for every json / jsonl file in an archive or directory."""
+    if os.path.isdir(path):
+        for name in os.listdir(path):
+            if name.endswith((".json", ".jsonl")):
+                with open(os.path.join(path, name), "rb") as f:
+                    yield name, f.read()
+    elif zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for name in archive.namelist():
+                if name.endswith((".json", ".jsonl")):
+                    yield os.path.basename(name), archive.read(name)
+    else:
+        with tarfile.open(path) as archive:
+            for member in archive:
+                if member.isfile() and member.name.endswith((".json", ".jsonl")):
+                    yield os.path.basename(member.name), archive.extractfile(member).read()
+
+
+def _records(content, name):
+    """Returns a dictionary of id -> record for a json object or json lines file."""
+    if name.endswith(".jsonl"):
+        records = (json.loads(line) for line in content.splitlines() if line.strip())
+        return {int(r["_key"]): r for r in records}
+    return {int(k): v for k, v in json.loads(content).items()}
+
+
+def _values(collection):
+    """everef nests dogma entries in a dictionary keyed by id, CCP uses plain lists."""
+    return collection.values() if isinstance(collection, dict) else collection or []
+
+
+def parse_export(path):
+    """Reads an export into dictionaries of type_id -> (group_id, attributes, effects) and group_id -> category_id."""
+    types, groups, dogma = {}, {}, {}
+    for name, content in _read_export(path):
+        match name:
+            case "types.json" | "types.jsonl":
+                types = _records(content, name)
+            case "groups.json" | "groups.jsonl":
+                groups = _records(content, name)
+            case "typeDogma.jsonl":
+                dogma = _records(content, name)
+
+    parsed_types = {}
+    for type_id, record in types.items():
+        record = {**record, **dogma.get(type_id, {})}
+        attributes = {
+            int(a.get("attribute_id", a.get("attributeID"))): float(a["value"])
+            for a in _values(record.get("dogma_attributes", record.get("dogmaAttributes")))
+        }
+        effects = [
+            int(e.get("effect_id", e.get("effectID")))
+            for e in _values(record.get("dogma_effects", record.get("dogmaEffects")))
+        ]
+        parsed_types[type_id] = (int(record.get("group_id", record.get("groupID"))), attributes, effects)
+
+    parsed_groups = {
+        group_id: int(record.get("category_id", record.get("categoryID")))
+        for group_id, record in groups.items()
+    }
+
+    return parsed_types, parsed_groups
+
+
+def build_index(types, groups, index_path):
+    """Writes the parsed export as flat arrays, so it can be memory-mapped instead of parsed on startup."""
+    if sys.byteorder != "little":
+        raise ValueError("The SDE index is stored little-endian and can only be built on little-endian machines.")
+
+    type_ids, group_ids, attribute_starts, effect_starts = array("I"), array("I"), array("I", [0]), array("I", [0])
+    attribute_ids, attribute_values, effect_ids = array("I"), array("d"), array("I")
+
+    for type_id in sorted(types):
+        group_id, attributes, effects = types[type_id]
+        type_ids.append(type_id)
+        group_ids.append(group_id)
+
+        for attribute_id in sorted(attributes):
+            attribute_ids.append(attribute_id)
+            attribute_values.append(attributes[attribute_id])
+        attribute_starts.append(len(attribute_ids))
+
+        effect_ids.extend(sorted(effects))
+        effect_starts.append(len(effect_ids))
+
+    sorted_groups = array("I", sorted(groups))
+    categories = array("I", [groups[g] for g in sorted_groups])
+
+    # The float64 values go first after the header, so they stay 8 byte aligned
+    with open(index_path + ".tmp", "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(type_ids), len(sorted_groups), len(attribute_ids), len(effect_ids)))
+        f.write(b"\0" * (-HEADER.size % 8))
+        for column in (attribute_values, type_ids, group_ids, attribute_starts, effect_starts,
+                       sorted_groups, categories, attribute_ids, effect_ids):
+            f.write(column.tobytes())
+    os.replace(index_path + ".tmp", index_path)
+
+
+class SdeIndex:
+    """Read-only view on an index file written by build_index."""
+
+    def __init__(self, path):
+        if sys.byteorder != "little":
+            raise ValueError("The SDE index can only be read on little-endian machines.")
+
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, n_types, n_groups, n_attributes, n_effects = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} SDE index.")
+
+        view = memoryview(self._mmap)
+        offset = HEADER.size + (-HEADER.size % 8)
+
+        def column(typecode, length):
+            nonlocal offset
+            size = length * array(typecode).itemsize
+            data = view[offset:offset + size].cast(typecode)
+            offset += size
+            return data
+
+        self.attribute_values = column("d", n_attributes)
+        self.type_ids = column("I", n_types)
+        self.group_ids = column("I", n_types)
+        self.attribute_starts = column("I", n_types + 1)
+        self.effect_starts = column("I", n_types + 1)
+        self.groups = column("I", n_groups)
+        self.categories = column("I", n_groups)
+        self.attribute_ids = column("I", n_attributes)
+        self.effect_ids = column("I", n_effects)
+
+    @staticmethod
+    def _find(ids, some_id):
+        index = bisect_left(ids, some_id)
+        if index < len(ids) and ids[index] == some_id:
+            return index
+        return None
+
+    def __contains__(self, type_id):
+        return self._find(self.type_ids, type_id) is not None
+
+    def group_id(self, type_id):
+        if (index := self._find(self.type_ids, type_id)) is None:
+            return None
+        return self.group_ids[index]
+
+    def category_id(self, type_id):
+        if (group_id := self.group_id(type_id)) is None:
+            return None
+        if (index := self._find(self.groups, group_id)) is None:
+            return None
+        return self.categories[index]
+
+    def dogma_attributes(self, type_id):
+        if (index := self._find(self.type_ids, type_id)) is None:
+            return None
+        start, end = self.attribute_starts[index], self.attribute_starts[index + 1]
+        return dict(zip(self.attribute_ids[start:end].tolist(), self.attribute_values[start:end].tolist()))
+
+    def dogma_attribute(self, type_id, attribute_id):
+        if (index := self._find(self.type_ids, type_id)) is None:
+            return None
+        start, end = self.attribute_starts[index], self.attribute_starts[index + 1]
+        for row in range(start, end):
+            if self.attribute_ids[row] == attribute_id:
+                return self.attribute_values[row]
+        return None
+
+    def dogma_effects(self, type_id):
+        if (index := self._find(self.type_ids, type_id)) is None:
+            return None
+        return self.effect_ids[self.effect_starts[index]:self.effect_starts[index + 1]].tolist()
+
+
+def load(path):
+    """Maps the index at `path`, returning None if no index is configured."""
+    if not path or not os.path.exists(path):
+        return None
+    return SdeIndex(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a memory-mapped index from a static data export.")
+    parser.add_argument("export", help="everef reference data or CCP SDE (jsonl), as archive or directory")
+    parser.add_argument("index", help="where to write the index file")
+    arguments = parser.parse_args()
+
+    build_index(*parse_export(arguments.export), arguments.index)
+    print(f"Wrote {arguments.index}")
@@ -0,0 +1,84 @@
+import asyncio
+import concurrent.futures
+import json
+import sqlite3
+
+
+class TypeStore:
+    """Persistent store for static data such as ESI types and groups.
+
+    Entries are kept as json per (kind, id) and dropped as a whole whenever the game version changes.
+
+    Parameters
+    ----------
+    path : str
+        Location of the sqlite database, created on first use.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        # The connection is only used on this thread, so the bot's event loop never waits for sqlite
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="type-store")
+
+    async def run(self, func, *args):
+        """Runs `func(*args)` on the store's thread, use it for every method below."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path)
+            with self._connection:
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS static_data ("
+                    "kind TEXT NOT NULL, id INTEGER NOT NULL, data TEXT NOT NULL, PRIMARY KEY (kind, id))"
+                )
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+                )
+        return self._connection
+
+    def check_version(self, version):
+        """Drops all stored data if it was collected for another game version."""
+        version = str(version)
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is not None and row[0] == version:
+            return False
+
+        with self.connection:
+            self.connection.execute("DELETE FROM static_data")
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (version,))
+        return True
+
+    def get(self, kind, ids) -> dict:
+        """Returns the stored data for all `ids` of `kind` that are known, keyed by id."""
+        ids = list(ids)
+        found = {}
+        # Stay below the sqlite limit for query parameters
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            rows = self.connection.execute(
+                f"SELECT id, data FROM static_data WHERE kind = ? AND id IN ({','.join('?' * len(chunk))})",
+                (kind, *chunk)
+            )
+            found.update({some_id: json.loads(data) for some_id, data in rows})
+        return found
+
+    def put(self, kind, items):
+        """Stores a dictionary of id -> data of `kind` in one transaction."""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO static_data (kind, id, data) VALUES (?, ?, ?)",
+                [(kind, some_id, json.dumps(data)) for some_id, data in items.items()]
+            )
+
+    def _close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def close(self):
+        """Closes the database once everything submitted before has run."""
+        self.executor.submit(self._close)
+        self.executor.shutdown(wait=True)
@@ -1,11 +1,21 @@
+import bisect
 import functools
+import math
+import os
 
 import logging
 
+import numpy as np
+
+from retry import DeadlineExceeded, time_budget
+
 # Configure the logger
 logger = logging.getLogger('discord.utils')
 logger.setLevel(logging.INFO)
 
+# Seconds a command may spend on requests before they give up
+COMMAND_DEADLINE = float(os.environ.get("COMMAND_DEADLINE", 300))
+
 
 def isk(number):
     """Takes a number and converts it into an ingame-like ISK format string.
@@ -43,42 +53,76 @@ def convert(number_string: str):
 
 
 class RelationalSorter:
-    @staticmethod
-    def interpolate(x1, y1, x2, y2, x_target):
-        assert (x1 <= x_target <= x2)
-        dx = x2 - x1
-        rx = x_target - x1
-        dy = y2 - y1
-
-        if dx != 0:
-            return y1 + dy / dx * rx
-        else:
-            return y1
-
-    def __init__(self, all_points):
-        # Add edge points to make sure it works properly
-        all_points.append((0, 0))
-        all_points.append((float("inf"), max([y for x, y in all_points])))
+    """Grades (price, bonus) points by their bonus relative to the best bonus available at that price.
 
-        self.best = list(sorted(all_points, key=lambda x: x[0]))
+    The best bonus is the upper hull of all points, a line from (0, 0) that bends down at every point on it and
+    stays flat after the highest bonus. Points on the hull get 1.0, everything else less.
 
-        old_len = 0
-        while (old_len != len(self.best)):
-            old_len = len(self.best)
+    Parameters
+    ----------
+    all_points : iterable
+        (price, bonus) pairs of everything that could be bought, it is not modified.
+    """
 
-            interpolated_prices = [0] + [
-                RelationalSorter.interpolate(*self.best[i - 1], *self.best[i + 1], self.best[i][0]) for i in
-                range(1, len(self.best) - 1)] + [0]
-            self.best = [i for i, j in zip(self.best, interpolated_prices) if i[1] > j]
+    def __init__(self, all_points):
+        # Only the highest bonus of every price can be on the hull, nothing without a price can be bought
+        highest = {0: 0}
+        for price, bonus in all_points:
+            if price != math.inf and bonus > highest.get(price, -math.inf):
+                highest[price] = bonus
+
+        # Monotone chain, dropping every point on or below the line between its neighbours
+        hull = []
+        for point in sorted(highest.items()):
+            while len(hull) >= 2 and _cross(hull[-2], hull[-1], point) >= 0:
+                hull.pop()
+            hull.append(point)
+
+        # Past the highest bonus the hull only falls, where it is kept flat instead
+        top = max(range(len(hull)), key=lambda i: hull[i][1])
+        self.best = hull[:top + 1] + [(math.inf, hull[top][1])]
+
+        self.prices = [price for price, _ in self.best[:-1]]
+        self.bonuses = [bonus for _, bonus in self.best[:-1]]
+
+    def hull(self, price):
+        """Best bonus available for `price`"""
+        index = bisect.bisect_right(self.prices, price)
+        if index == len(self.prices):
+            return self.bonuses[-1]
+
+        x1, y1, x2, y2 = self.prices[index - 1], self.bonuses[index - 1], self.prices[index], self.bonuses[index]
+        return y1 + (y2 - y1) / (x2 - x1) * (price - x1)
 
     def __call__(self, point):
-        try:
-            index = next(i for i, val in enumerate(self.best) if val[0] > point[0])
-        except StopIteration:
+        price, bonus = point
+        if price == math.inf or (best := self.hull(price)) <= 0:
             return 1.0
-        else:
-            interpolated_bonus = RelationalSorter.interpolate(*self.best[index - 1], *self.best[index], point[0])
-            return point[1] / interpolated_bonus
+        return bonus / best
+
+    def score_many(self, prices, bonuses):
+        """Grades many points at once, returns a numpy array"""
+        prices = np.asarray(prices, dtype=float)
+        best = np.interp(prices, self.prices, self.bonuses)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = np.asarray(bonuses, dtype=float) / best
+        return np.where((prices == math.inf) | (best <= 0), 1.0, scores)
+
+
+def _cross(origin, a, b):
+    return (a[0] - origin[0]) * (b[1] - origin[1]) - (a[1] - origin[1]) * (b[0] - origin[0])
+
+
+def pareto_frontier(points):
+    """Returns the (price, bonus) points no other point beats with a lower price and a higher bonus, by price.
+
+    RelationalSorter only needs these points, as all others are below its upper hull.
+    """
+    frontier = []
+    for price, bonus in sorted(points, key=lambda p: (p[0], -p[1])):
+        if not frontier or bonus > frontier[-1][1]:
+            frontier.append((price, bonus))
+    return frontier
 
 
 def unix_style_arg_parser(args, separator=" ", letter_argument="-", word_argument="--"):
@@ -122,7 +166,11 @@ def command_error_handler(func):
         logger.info(f"{ctx.author.name} used !{func.__name__}")
 
         try:
-            return await func(*args, **kwargs)
+            with time_budget(COMMAND_DEADLINE):
+                return await func(*args, **kwargs)
+        except DeadlineExceeded as e:
+            logger.warning(f"!{func.__name__} ran out of time: {e}")
+            await ctx.send(f"!{func.__name__} took too long, try again later.")
         except Exception as e:
             logger.error(f"Error in !{func.__name__} command: {e}", exc_info=True)
             await ctx.send(f"An error occurred in !{func.__name__}.")
@@ -139,7 +187,16 @@ def slash_command_error_handler(func):
         logger.info(f"{interaction.user.name} used !{func.__name__} {arguments} {kwargs}")
 
         try:
-            return await func(*args, **kwargs)
+            with time_budget(COMMAND_DEADLINE):
+                return await func(*args, **kwargs)
+        except DeadlineExceeded as e:
+            logger.warning(f"!{func.__name__} ran out of time: {e}")
+            # Commands defer first, without an answer the user would see "thinking…" forever
+            message = f"/{func.__name__} took too long, try again later."
+            if interaction.response.is_done():
+                await interaction.followup.send(message)
+            else:
+                await interaction.response.send_message(message)
         except Exception as e:
             logger.error(f"Error in !{func.__name__} command: {e}", exc_info=True)
 